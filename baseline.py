@@ -0,0 +1,339 @@
+"""Per-pixel baselines for monitoring new acquisitions.
+
+A baseline keeps, for every pixel of a fixed grid, the last baseline_observations valid values
+of each thresholded index and how many there are. A new scene is compared with the median (or
+max) of those values, then folded in, so one cloudy or hazy scene no longer decides a result
+and each new acquisition is read once instead of being paired with its history:
+
+    python baseline.py amazon A B C       # fold the given folders, in acquisition order
+    python baseline.py amazon             # fold every catalogued scene that is newer
+
+The grid is that of the first scene folded in; later scenes are resampled onto it like pairs
+are. Each baseline is one GeoTIFF, baselines/<name>/history.tif, holding per index
+baseline_observations bands (oldest first, empty as no data) and a valid-count band, with the
+folded scenes in its tags. Updates write a new file and then replace the old one, so a failed
+update leaves the baseline as it was.
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.windows import Window
+
+import batch
+import catalog
+import ndvi_calc
+import result_cache
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+BASELINE_PATH = ndvi_calc.BASE_PATH / ndvi_calc.config["baseline_folder"]
+HISTORY_FILE = "history.tif"
+# Valid observations kept per pixel and index
+BASELINE_OBSERVATIONS = ndvi_calc.config["baseline_observations"]
+if BASELINE_OBSERVATIONS < 1:
+    raise ValueError("baseline_observations must be at least 1")
+# Taken over the kept observations when comparing, so it can differ from one update to the next
+BASELINE_STATISTIC = ndvi_calc.config["baseline_statistic"]
+BASELINE_STATISTICS = ("median", "max")
+if BASELINE_STATISTIC not in BASELINE_STATISTICS:
+    raise ValueError(f"Unsupported baseline_statistic: {BASELINE_STATISTIC}")
+# Pixels with fewer kept observations are folded but not compared
+BASELINE_MIN_OBSERVATIONS = ndvi_calc.config["baseline_min_observations"]
+# Stored, decoded, sorted and folded observations of every index, plus the change working set
+BASELINE_BYTES_PER_PIXEL = 16 * (BASELINE_OBSERVATIONS + 1) * len(ndvi_calc.CHANGE_THRESHOLDS) + ndvi_calc.CHANGE_BYTES_PER_PIXEL
+NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+# Flocked for the whole of an update, so updates of a baseline from any process or thread run one at a time
+LOCK_FILE = ".lock"
+
+def baseline_path(name):
+    """Returns the history raster of a baseline, raising ValueError for a name that isn't a plain folder name."""
+    if not isinstance(name, str) or not NAME_PATTERN.fullmatch(name):
+        raise ValueError(f"Invalid baseline name: {name}")
+    return BASELINE_PATH / name / HISTORY_FILE
+
+@contextmanager
+def baseline_lock(name):
+    """Holds an exclusive flock on baselines/<name>/.lock."""
+    path = baseline_path(name).with_name(LOCK_FILE)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def storage_params(L):
+    """Returns what the kept observations depend on; a baseline only takes scenes computed alike."""
+    return {"L": L, "indices": {name: ndvi_calc.INDEX_EXPRESSIONS[name] for name in ndvi_calc.CHANGE_THRESHOLDS},
+            "observations": BASELINE_OBSERVATIONS}
+
+def index_bands(position, observations):
+    """Returns the 1-based observation bands and count band of the index at position in the history raster."""
+    first = position * (observations + 1) + 1
+    return list(range(first, first + observations)), first + observations
+
+def load_state(path):
+    """Returns the parameters and folded scenes recorded in a history raster, or None if there is none."""
+    if not path.exists():
+        return None
+    with rasterio.open(path) as src:
+        return json.loads(src.tags()["baseline"])
+
+def baseline_info(name):
+    """Returns the grid, parameters and folded scenes of a baseline, or raises FileNotFoundError."""
+    path = baseline_path(name)
+    if not path.exists():
+        raise FileNotFoundError(f"Baseline not found: {name}")
+    with rasterio.open(path) as src:
+        state = json.loads(src.tags()["baseline"])
+        return dict(name=name, crs=src.crs.to_string() if src.crs else None, bounds=list(src.bounds), width=src.width,
+                    height=src.height, transform=list(src.transform)[:6], **state)
+
+def baseline_statistic(observations, count, statistic=BASELINE_STATISTIC):
+    """Returns the median or max of each pixel's count kept observations, NaN where there are none.
+
+    Empty observations are NaN and sort last, so the statistic is read at positions set by count.
+    """
+    ordered = np.sort(observations, axis=0)
+    last = np.maximum(count - 1, 0)
+    low, high = (last, last) if statistic == "max" else (last // 2, count // 2)
+    take = lambda position: np.take_along_axis(ordered, position[None], axis=0)[0]
+    return (take(low) + take(high)) / np.float32(2)
+
+def fold_observation(observations, count, value):
+    """Appends value to each pixel's observations where it is valid, dropping the oldest once all are kept."""
+    valid = np.isfinite(value)
+    folded = np.where(valid, np.concatenate([observations[1:], value[None]]), observations)
+    return folded, np.where(valid, np.minimum(count + 1, len(observations)), count)
+
+def comparison_result(deforested_pixels, total_pixels, alert_threshold):
+    if not total_pixels:
+        return {"deforestation_percentage": None, "status": "Baseline has too few observations to compare yet"}
+    return ndvi_calc.deforestation_result(deforested_pixels, total_pixels, alert_threshold)
+
+def fold_scene(path, state, entry, scene_folder, thresholds, alert_threshold, statistic=BASELINE_STATISTIC, min_observations=BASELINE_MIN_OBSERVATIONS,
+               tile_memory_mb=ndvi_calc.TILE_MEMORY_MB, timings=None):
+    """Compares a scene's index rasters with the history raster at path, then replaces it with the scene folded in.
+
+    entry, completed with the comparison's pixel counts and result, is added to the folded scenes
+    of state, which the new history raster records. Returns the top hotspot patches of the comparison.
+    """
+    names, observations = list(state["params"]["indices"]), state["params"]["observations"]
+    staging = path.with_name(f".{path.name}-{os.getpid()}-{threading.get_ident()}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with ExitStack() as stack:
+            open_raster = lambda raster: stack.enter_context(rasterio.open(raster, num_threads="all_cpus"))
+            history = open_raster(path) if path.exists() else None
+            scenes = {name: open_raster(Path(scene_folder) / f"{name}.tif") for name in names}
+            ref = history if history is not None else scenes[names[0]]
+            # The part of the baseline grid the scene covers; the rest of the baseline is kept as is
+            grid = ndvi_calc.overlap_window(ref, list(scenes.values()))
+            inputs = {name: (ndvi_calc.aligned_source(src, ref, grid, stack), ndvi_calc.storage_scale(src)) for name, src in scenes.items()}
+            scale = ndvi_calc.STORAGE_SCALE
+            history_scale = ndvi_calc.storage_scale(history) if history is not None else scale
+            # When everything is scaled int16 alike, values and thresholds stay in stored units, so
+            # comparisons match those of pairs; otherwise they are decoded to float
+            scales = {scale, history_scale, *(source_scale for _, source_scale in inputs.values())}
+            unit = scale if len(scales) == 1 and scale else None
+            if unit:
+                thresholds = {name: round(threshold / unit, 6) for name, threshold in thresholds.items()}
+            in_units = lambda source_scale: 1.0 if unit else source_scale
+
+            def read_scene(name, window):
+                tile = np.full((window.height, window.width), np.nan, dtype=np.float32)
+                if windows.intersect(window, grid):
+                    part = windows.intersection(window, grid)
+                    source, source_scale = inputs[name]
+                    data = ndvi_calc.read_aligned(source, Window(part.col_off - grid.col_off, part.row_off - grid.row_off, part.width, part.height))
+                    tile[part.row_off - window.row_off:part.row_off - window.row_off + part.height,
+                         part.col_off - window.col_off:part.col_off - window.col_off + part.width] = ndvi_calc.decode_index(data, in_units(source_scale))
+                return tile
+
+            meta = ndvi_calc.index_meta(dict(ref.meta, nodata=None), scale)
+            meta.update(count=len(names) * (observations + 1))
+            # Internal state, never served: tiled and compressed, without overviews or COG layout
+            dst = stack.enter_context(rasterio.open(staging, 'w', **ndvi_calc.output_meta(meta), num_threads="all_cpus"))
+            dst.scales = tuple(band_scale for _ in names for band_scale in [scale or 1.0] * observations + [1.0])
+            dst.offsets = (0.0,) * dst.count
+            dst.descriptions = tuple(f"{name}_{label}" for name in names for label in [*range(1, observations + 1), "count"])
+
+            deforested_pixels = compared_pixels = observed_pixels = 0
+            hotspots = ndvi_calc.new_hotspots(ref.height, ref.width)
+            for window in ndvi_calc.tile_windows(ref, tile_memory_mb, BASELINE_BYTES_PER_PIXEL):
+                start = time.perf_counter()
+                stored = history.read(window=window) if history is not None else None
+                new = {name: read_scene(name, window) for name in names}
+                read_done = time.perf_counter()
+
+                shape = (window.height, window.width)
+                deforested, compared, observed = np.ones(shape, dtype=bool), np.ones(shape, dtype=bool), np.ones(shape, dtype=bool)
+                bands = []
+                for position, name in enumerate(names):
+                    if stored is None:
+                        kept, count = np.full((observations, *shape), np.nan, dtype=np.float32), np.zeros(shape, dtype=np.int64)
+                    else:
+                        observation_bands, count_band = index_bands(position, observations)
+                        kept = ndvi_calc.decode_index(stored[observation_bands[0] - 1:observation_bands[-1]], in_units(history_scale))
+                        count = stored[count_band - 1].astype(np.int64)
+                    change = new[name] - baseline_statistic(kept, count, statistic)
+                    valid = np.isfinite(new[name])
+                    compared &= valid & (count >= min_observations)
+                    observed &= valid
+                    deforested &= change < thresholds[name]
+                    kept, count = fold_observation(kept, count, new[name])
+                    bands += [*ndvi_calc.encode_index(kept, in_units(scale)), count.astype(meta["dtype"])]
+                deforested &= compared
+                computed = time.perf_counter()
+
+                deforested_pixels += int(np.count_nonzero(deforested))
+                compared_pixels += int(np.count_nonzero(compared))
+                observed_pixels += int(np.count_nonzero(observed))
+                ndvi_calc.add_hotspot_tile(hotspots, window, deforested)
+                hotspots_done = time.perf_counter()
+                dst.write(np.stack(bands), window=window)
+
+                bytes_read = (0 if stored is None else stored.nbytes) + sum(tile.nbytes for tile in new.values())
+                ndvi_calc.add_timing(timings, "read", read_done - start, bytes_read=bytes_read)
+                ndvi_calc.add_timing(timings, "baseline", computed - read_done)
+                ndvi_calc.add_timing(timings, "hotspots", hotspots_done - computed)
+                ndvi_calc.add_timing(timings, "write", time.perf_counter() - hotspots_done)
+
+            entry.update(deforested_pixels=deforested_pixels, total_pixels=compared_pixels, observed_pixels=observed_pixels,
+                         **comparison_result(deforested_pixels, compared_pixels, alert_threshold))
+            state["scenes"].append(entry)
+            dst.update_tags(baseline=json.dumps(state))
+            summary = ndvi_calc.hotspot_summary(hotspots, ref.transform, ref.crs)
+        os.replace(staging, path)
+    finally:
+        staging.unlink(missing_ok=True)
+    ndvi_calc.add_timing(timings, "write", 0, bytes_written=ndvi_calc.file_sizes(path))
+    ndvi_calc.record_peaks(timings, "read", "baseline", "hotspots", "write")
+    return summary["patches"]
+
+def folded_entry(name, state, folder, scene, key, params):
+    """Returns the recorded entry of a scene already folded into a baseline's state, or None if it can be folded.
+
+    Raises ValueError if the baseline was built with other parameters or has a later scene.
+    """
+    if state["params"] != storage_params(params["L"]):
+        raise ValueError(f"Baseline {name} was built with other index parameters")
+    for entry in state["scenes"]:
+        if entry["scene_key"] == key:
+            return entry
+    latest = max((entry["acquired"] for entry in state["scenes"] if entry["acquired"]), default=None)
+    if scene["acquired"] and latest and scene["acquired"] < latest:
+        raise ValueError(f"Scene {folder} was acquired on {scene['acquired']}, before the latest scene of baseline {name} ({latest})")
+    return None
+
+def check_update(name, folder, params, statistic=BASELINE_STATISTIC, min_observations=BASELINE_MIN_OBSERVATIONS):
+    """Validates an update without reading any raster, returning the baseline's history path and the scene's catalog entry.
+
+    Raises ValueError or FileNotFoundError like update_baseline, so a request can be refused before it is queued.
+    """
+    if statistic not in BASELINE_STATISTICS:
+        raise ValueError(f"Unknown baseline statistic: {statistic}")
+    if isinstance(min_observations, bool) or not isinstance(min_observations, int) or not 1 <= min_observations <= BASELINE_OBSERVATIONS:
+        raise ValueError(f"min_observations must be an integer from 1 to {BASELINE_OBSERVATIONS}")
+    path = baseline_path(name)
+    scene = catalog.get_scene(folder)
+    state = load_state(path)
+    if state is not None:
+        folded_entry(name, state, folder, scene, ndvi_calc.scene_key(folder, params["L"]), params)
+    return path, scene
+
+def update_baseline(name, folder, params=None, statistic=BASELINE_STATISTIC, min_observations=BASELINE_MIN_OBSERVATIONS,
+                    tile_memory_mb=ndvi_calc.TILE_MEMORY_MB, timings=None):
+    """Compares a scene folder with a baseline, folds the scene into it and returns the comparison.
+
+    The first scene creates the baseline, with nothing to compare yet. total_pixels counts the
+    pixels compared: observed in the scene and with at least min_observations kept. A scene is
+    folded once; asking again returns its recorded result. Raises ValueError for a scene acquired
+    before the latest folded one, computed with other parameters than the baseline, or not
+    overlapping it.
+    """
+    params = params or ndvi_calc.ANALYSIS_PARAMS
+    path, scene = check_update(name, folder, params, statistic, min_observations)
+
+    with baseline_lock(name):
+        state = load_state(path) or {"params": storage_params(params["L"]), "scenes": []}
+        key = ndvi_calc.scene_key(folder, params["L"])
+        folded = folded_entry(name, state, folder, scene, key, params)
+        if folded is not None:
+            return folded
+
+        entry = {"folder": folder, "scene_key": key, "acquired": scene["acquired"], "statistic": statistic, "min_observations": min_observations}
+        with ndvi_calc.scene_products(folder, params["L"], timings) as scene_folder:
+            hotspots = fold_scene(path, state, entry, scene_folder, ndvi_calc.change_thresholds(params), params["deforestation_alert_threshold"],
+                                  statistic, min_observations, tile_memory_mb, timings)
+    return dict(entry, hotspots=hotspots)
+
+def pending_folders(name):
+    """Returns the catalogued scenes a baseline could take next, in acquisition order.
+
+    These are the scenes not folded yet that overlap the baseline and were not acquired before
+    its latest scene; every scene, for a baseline that doesn't exist yet.
+    """
+    scenes = catalog.list_scenes()
+    try:
+        info = baseline_info(name)
+    except FileNotFoundError:
+        return [scene["name"] for scene in scenes]
+    folded = {entry["folder"] for entry in info["scenes"]}
+    latest = max((entry["acquired"] for entry in info["scenes"] if entry["acquired"]), default=None)
+    overlapping = set(catalog.overlapping(info["bounds"], crs=info["crs"])) if info["crs"] else {scene["name"] for scene in scenes}
+    return [scene["name"] for scene in scenes if scene["name"] not in folded and scene["name"] in overlapping
+            and not (latest and scene["acquired"] and scene["acquired"] < latest)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold acquisitions into a per-pixel baseline and report the change of each against it.")
+    parser.add_argument("name", help="baseline to update, created from the first folder folded into it")
+    parser.add_argument("folders", nargs="*", help="acquisition folders to fold, in acquisition order (default: every pending catalogued scene)")
+    parser.add_argument("--statistic", choices=BASELINE_STATISTICS, default=BASELINE_STATISTIC)
+    parser.add_argument("--min-observations", type=int, default=BASELINE_MIN_OBSERVATIONS,
+                        help=f"kept observations a pixel needs to be compared (1 to {BASELINE_OBSERVATIONS})")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    if not 1 <= args.min_observations <= BASELINE_OBSERVATIONS:
+        parser.error(f"--min-observations must be from 1 to {BASELINE_OBSERVATIONS}")
+    catalog.scan(checksums=False)
+    try:
+        baseline_path(args.name)
+        folders = batch.order_folders(args.folders) if args.folders else pending_folders(args.name)
+    except (ValueError, FileNotFoundError) as e:
+        parser.error(str(e))
+
+    rows = []
+    for folder in folders:
+        try:
+            result = update_baseline(args.name, folder, statistic=args.statistic, min_observations=args.min_observations)
+        except ValueError as e:
+            logging.warning(f"Skipped {folder}: {e}")
+            continue
+        result.pop("hotspots", None)
+        logging.info(f"Folded {folder} into {args.name}: {result['status']}")
+        rows.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(rows, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    result_cache.sweep_once()
+
+if __name__ == "__main__":
+    main()
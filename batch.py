@@ -0,0 +1,133 @@
+"""Batch change detection over an archive of acquisition folders.
+
+Computes every scene's indices once (through the scene cache), then evaluates consecutive
+or all pairs, spreading both stages over a process pool sized to the machine:
+
+    python batch.py                       # every folder, consecutive pairs
+    python batch.py A B C --pairs all     # the given folders, all pairs
+    python batch.py --start 2020 --end 2023 --output changes.csv
+
+Folders are ordered by acquisition date from the scene catalog (read from an MTL file, a date in
+the folder name or the TIFF tags), then by name; pairs of scenes that don't overlap are skipped.
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+import catalog
+import ndvi_calc
+import result_cache
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+COLUMNS = ["start_folder", "end_folder", "deforestation_percentage", "deforested_pixels", "total_pixels", "status"]
+
+def list_folders(start=None, end=None):
+    """Returns the catalogued scene folders in acquisition order, limited to [start, end].
+
+    start and end are compared with the acquisition date, or the folder name of undated scenes,
+    as prefixes: --start 2020 --end 2023 keeps every scene of 2020 through 2023.
+    """
+    folders = []
+    for scene in catalog.list_scenes():
+        order = scene["acquired"] or scene["name"]
+        if (start is None or order >= start) and (end is None or order[:len(end)] <= end):
+            folders.append(scene["name"])
+    return folders
+
+def order_folders(folders):
+    """Returns the given folders in acquisition order, raising FileNotFoundError for unknown ones."""
+    for folder in folders:
+        catalog.get_scene(folder)
+    folders = set(folders)
+    return [scene["name"] for scene in catalog.list_scenes() if scene["name"] in folders]
+
+def plan_pairs(folders, mode="consecutive"):
+    """Returns the pairs to evaluate, leaving out scenes that don't overlap."""
+    if mode == "all":
+        pairs = list(itertools.combinations(folders, 2))
+    else:
+        pairs = list(zip(folders, folders[1:]))
+    planned = [pair for pair in pairs if catalog.overlap(*map(catalog.get_scene, pair))]
+    if len(planned) < len(pairs):
+        logging.info(f"Skipped {len(pairs) - len(planned)} pairs of scenes that don't overlap")
+    return planned
+
+def prepare_scene(folder, L):
+    """Computes a scene's products into the scene cache, unless they are there already."""
+    with ndvi_calc.scene_products(folder, L):
+        pass
+
+def analyze_pair(pair, params):
+    """Runs change detection for one pair on the cached scene products."""
+    start_folder, end_folder = pair
+    with ndvi_calc.scene_products(start_folder, params["L"]) as old_scene, ndvi_calc.scene_products(end_folder, params["L"]) as new_scene:
+        change = ndvi_calc.detect_change(old_scene, new_scene, thresholds=ndvi_calc.change_thresholds(params))
+    result = ndvi_calc.deforestation_result(change["deforested_pixels"], change["total_pixels"], params["deforestation_alert_threshold"])
+    result.update(start_folder=start_folder, end_folder=end_folder, deforested_pixels=change["deforested_pixels"], total_pixels=change["total_pixels"])
+    return result
+
+def run_batch(folders, mode="consecutive", params=None, workers=None):
+    """Computes each scene once, then every planned pair, and returns one row per pair."""
+    params = params or ndvi_calc.ANALYSIS_PARAMS
+    pairs = plan_pairs(folders, mode)
+    scenes = sorted(set(itertools.chain.from_iterable(pairs)))
+
+    # Every scene stays leased until the last pair is evaluated, so no sweep evicts it in between
+    with ExitStack() as leases, ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for folder in scenes:
+            leases.enter_context(result_cache.lease(ndvi_calc.scene_key(folder, params["L"]), result_cache.SCENE_CACHE_PATH))
+        # Scenes first, so no two pairs race to compute the same scene
+        list(executor.map(prepare_scene, scenes, itertools.repeat(params["L"])))
+        logging.info(f"Computed indices for {len(scenes)} scenes")
+        rows = list(executor.map(analyze_pair, pairs, itertools.repeat(params)))
+
+    logging.info(f"Evaluated {len(rows)} pairs")
+    return rows
+
+def write_table(rows, output, output_format="csv"):
+    if output_format == "json":
+        json.dump([{column: row[column] for column in COLUMNS} for row in rows], output, indent=2)
+        output.write("\n")
+        return
+    writer = csv.DictWriter(output, fieldnames=COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch NDVI/SAVI change detection over many acquisition folders.")
+    parser.add_argument("folders", nargs="*", help="acquisition folders to process (default: every folder)")
+    parser.add_argument("--start", help="first acquisition date (or folder name, for undated scenes) to include")
+    parser.add_argument("--end", help="last acquisition date (or folder name, for undated scenes) to include")
+    parser.add_argument("--pairs", choices=["consecutive", "all"], default="consecutive")
+    parser.add_argument("--workers", type=int, help="process pool size (default: CPU count)")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--output", help="file to write the table to (default: stdout)")
+    args = parser.parse_args()
+    # Scanned once up front; a one-off run has no use for the catalog's checksums
+    catalog.scan(checksums=False)
+
+    try:
+        folders = order_folders(args.folders) if args.folders else list_folders(args.start, args.end)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    if len(folders) < 2:
+        parser.error("at least two folders are needed")
+
+    rows = run_batch(folders, args.pairs, workers=args.workers)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_table(rows, f, args.format)
+    else:
+        write_table(rows, sys.stdout, args.format)
+    # Without the server's sweep thread, the caches are brought back under their limits here
+    result_cache.sweep_once()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""Benchmarks the analysis stages on synthetic Landsat-sized scenes.
+
+Generates a pair of georeferenced band4/band5 GeoTIFFs per size (the new scene shifted east
+and with a cleared patch, like a neighbouring acquisition), then times each stage in a fresh
+process and records its wall time and peak RSS as JSON:
+
+    python benchmark.py                              # every size and stage
+    python benchmark.py --sizes 1k --repeat 3
+    python benchmark.py --stages compute_indices detect_change --output bench.json
+
+Pass --workdir to keep the generated scenes between runs; they are only written once.
+"""
+import argparse
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import ndvi_calc
+import nvdiOgscript
+import result_cache
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# (height, width); "scene" is a full Landsat 8 OLI path/row
+SIZES = {"1k": (1024, 1024), "8k": (8192, 8192), "scene": (7861, 7731)}
+# The new scene is shifted east by this fraction of its width, so the pair only partly overlaps
+SCENE_SHIFT = 0.1
+PIXEL_SIZE = 30
+ROWS_PER_WRITE = 1024
+
+def write_band(path, height, width, left, band, cleared=False, seed=0):
+    """Writes a synthetic uint16 Landsat-like band with smooth vegetation and a zero-filled border."""
+    profile = dict(driver="GTiff", height=height, width=width, count=1, dtype="uint16", crs="EPSG:32633",
+                   transform=from_origin(left, 4000000, PIXEL_SIZE, PIXEL_SIZE), tiled=True, blockxsize=512, blockysize=512, compress="deflate")
+    rng = np.random.default_rng(seed)
+    border = max(height, width) // 50
+    x = np.arange(width, dtype=np.float32)
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, height, ROWS_PER_WRITE):
+            rows = min(ROWS_PER_WRITE, height - row)
+            y = np.arange(row, row + rows, dtype=np.float32)[:, None]
+            vegetation = np.clip(0.5 + 0.5 * np.sin(x / 150) * np.cos(y / 110), 0, 1)
+            if cleared:
+                vegetation[(y >= height // 3) & (y < height // 2) & (x >= width // 3) & (x < width // 2)] = 0.1
+            if band == "band4":
+                data = 9000 - 3000 * vegetation + rng.normal(0, 300, vegetation.shape)
+            else:
+                data = 12000 + 12000 * vegetation + rng.normal(0, 500, vegetation.shape)
+            data = data.clip(1, 65535).astype(np.uint16)
+            data[:, :border] = data[:, width - border:] = 0
+            if row < border:
+                data[:border - row] = 0
+            if row + rows > height - border:
+                data[max(height - border - row, 0):] = 0
+            dst.write(data, 1, window=((row, row + rows), (0, width)))
+
+def make_scenes(workdir, size):
+    """Writes (once) the old and new synthetic scenes of a size and returns their folders."""
+    height, width = SIZES[size]
+    folders = {}
+    for name, shift, cleared in (("old", 0, False), ("new", int(width * SCENE_SHIFT), True)):
+        folder = workdir / size / name
+        folders[name] = folder
+        if all((folder / f"{band}.TIF").exists() for band in ("band4", "band5")):
+            continue
+        folder.mkdir(parents=True, exist_ok=True)
+        for seed, band in enumerate(("band4", "band5")):
+            write_band(folder / f"{band}.TIF", height, width, 500000 + shift * PIXEL_SIZE, band, cleared, seed)
+        logging.info(f"Generated {size} {name} scene in {folder}")
+    return folders
+
+def make_fixtures(workdir, size):
+    """Computes (once) the index and change rasters the later stages read, and returns all paths."""
+    scenes = make_scenes(workdir, size)
+    fixtures = workdir / size / "fixtures"
+    paths = {"work": workdir / size / "work", "fixtures": fixtures}
+    for name, folder in scenes.items():
+        paths[f"red_{name}"], paths[f"nir_{name}"] = folder / "band4.TIF", folder / "band5.TIF"
+        # Laid out like scene cache entries, so detect_change can take the folders
+        paths[f"scene_{name}"] = fixtures / name
+        for index in ndvi_calc.INDEX_EXPRESSIONS:
+            paths[f"{index}_{name}"] = fixtures / name / f"{index}.tif"
+    for index in ndvi_calc.INDEX_EXPRESSIONS:
+        paths[f"{index}_change"] = fixtures / f"{index}_change.tif"
+
+    if not all(path.exists() for name, path in paths.items() if name.endswith(("_old", "_new", "_change"))):
+        for name in scenes:
+            paths[f"scene_{name}"].mkdir(parents=True, exist_ok=True)
+            ndvi_calc.compute_indices({"red": paths[f"red_{name}"], "nir": paths[f"nir_{name}"]}, paths[f"scene_{name}"])
+        for index in ndvi_calc.INDEX_EXPRESSIONS:
+            ndvi_calc.compare_indices(paths[f"{index}_old"], paths[f"{index}_new"], paths[f"{index}_change"])
+    return paths
+
+# Each stage is a context manager that prepares its inputs and yields the callable to time
+
+@contextmanager
+def compute_indices_stage(paths):
+    out = paths["work"]
+    yield lambda: ndvi_calc.compute_indices({"red": paths["red_old"], "nir": paths["nir_old"]}, out)
+
+@contextmanager
+def legacy_compute_indices_stage(paths):
+    out = paths["work"]
+    yield lambda: nvdiOgscript.compute_indices(paths["red_old"], paths["nir_old"], out / "ndvi.tif", out / "savi.tif", out / "ndvi.png", out / "savi.png")
+
+@contextmanager
+def dark_object_subtraction_stage(paths):
+    with rasterio.open(paths["red_old"]) as src:
+        band = src.read(1).astype(np.float32)
+        # Timed like compute_indices does it: the streamed dark object value, then the in-place subtraction
+        yield lambda: nvdiOgscript.dark_object_subtraction(band, nvdiOgscript.dark_object_value(src))
+
+@contextmanager
+def compare_indices_stage(paths):
+    yield lambda: ndvi_calc.compare_indices(paths["ndvi_old"], paths["ndvi_new"], paths["work"] / "ndvi_change.tif")
+
+@contextmanager
+def detect_deforestation_stage(paths):
+    yield lambda: ndvi_calc.detect_deforestation({index: paths[f"{index}_change"] for index in ndvi_calc.CHANGE_THRESHOLDS})
+
+@contextmanager
+def detect_change_stage(paths):
+    yield lambda: ndvi_calc.detect_change(paths["scene_old"], paths["scene_new"])
+
+@contextmanager
+def save_as_png_stage(paths):
+    yield lambda: nvdiOgscript.save_as_png(paths["ndvi_old"], paths["work"] / "ndvi.png", -1, 1)
+
+@contextmanager
+def save_quicklook_stage(paths):
+    yield lambda: ndvi_calc.save_quicklook(paths["ndvi_old"], paths["work"] / "ndvi.png")
+
+def redirect(module, name, path):
+    """Points a module's path constant, and the functions taking it as a default argument, at path."""
+    previous = getattr(module, name)
+    setattr(module, name, path)
+    for value in vars(module).values():
+        # Context managers keep their defaults on the generator function they wrap
+        function = inspect.unwrap(value) if callable(value) else value
+        if inspect.isfunction(function) and function.__defaults__ and previous in function.__defaults__:
+            function.__defaults__ = tuple(path if value == previous else value for value in function.__defaults__)
+
+@contextmanager
+def run_analysis_stage(paths, warm=False):
+    """Times GET /run-analysis through the Flask test client, on empty caches unless warm.
+
+    The input folder, catalog and both caches are redirected into a folder of the stage's
+    workdir before the server is imported, so the benchmark never reads or writes user data.
+    """
+    import catalog
+    import sources
+
+    root = Path(tempfile.mkdtemp(prefix="run_analysis-", dir=paths["work"]))
+    redirect(sources, "DATA_FOLDER", root / "input")
+    redirect(catalog, "DATA_FOLDER", sources.DATA_FOLDER)
+    redirect(result_cache, "CACHE_PATH", root / "result_cache")
+    redirect(result_cache, "SCENE_CACHE_PATH", root / "scene_cache")
+    redirect(catalog, "CATALOG_PATH", result_cache.SCENE_CACHE_PATH / "catalog.json")
+    # Imported only now, as its cache sweep thread starts on import
+    import server
+
+    folders = ("benchmark-old", "benchmark-new")
+    for folder, name in zip(folders, ("old", "new")):
+        (sources.DATA_FOLDER / folder).mkdir(parents=True)
+        for band in ("band4", "band5"):
+            ndvi_calc.link_or_copy(paths[f"{'red' if band == 'band4' else 'nir'}_{name}"], sources.DATA_FOLDER / folder / f"{band}.TIF")
+    # Scanned now so the catalog's checksums stay out of the timed runs
+    catalog.refresh(force=True)
+    client = server.app.test_client()
+
+    def run():
+        response = client.get("/run-analysis", query_string={"folder": "_".join(folders)})
+        # Analyses outlasting the request's wait are followed on their job until they finish
+        while response.get_json()["status"] in ("queued", "running"):
+            response = client.get(f"/jobs/{response.get_json()['job_id']}", query_string={"wait": server.MAX_WAIT_SECONDS})
+        if response.get_json()["status"] not in ("success", "done"):
+            raise RuntimeError(f"/run-analysis failed: {response.get_json()}")
+
+    try:
+        if warm:
+            run()
+        yield run
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+@contextmanager
+def run_analysis_warm_stage(paths):
+    with run_analysis_stage(paths, warm=True) as run:
+        yield run
+
+STAGES = {
+    "compute_indices": compute_indices_stage,
+    "legacy_compute_indices": legacy_compute_indices_stage,
+    "dark_object_subtraction": dark_object_subtraction_stage,
+    "compare_indices": compare_indices_stage,
+    "detect_deforestation": detect_deforestation_stage,
+    "detect_change": detect_change_stage,
+    "save_as_png": save_as_png_stage,
+    "save_quicklook": save_quicklook_stage,
+    "run_analysis_cold": run_analysis_stage,
+    "run_analysis_warm": run_analysis_warm_stage,
+}
+
+def measure(stage, paths):
+    """Runs one stage in the current process and returns its wall time and memory high-water marks."""
+    paths["work"].mkdir(parents=True, exist_ok=True)
+    with STAGES[stage](paths) as run:
+        setup_rss_mb = ndvi_calc.peak_rss_mb()
+        start = time.perf_counter()
+        run()
+        wall_seconds = time.perf_counter() - start
+        return {"wall_seconds": round(wall_seconds, 4), "peak_rss_mb": ndvi_calc.peak_rss_mb(), "setup_rss_mb": setup_rss_mb}
+
+def run_stage(stage, paths, repeat=1):
+    """Measures a stage repeat times, each in a fresh process, keeping the best wall time and the highest peak RSS."""
+    runs = []
+    for _ in range(repeat):
+        # A fresh spawned process per run, so peak RSS and warm imports don't leak between stages
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            runs.append(executor.submit(measure, stage, paths).result())
+    return {
+        "wall_seconds": min(run["wall_seconds"] for run in runs),
+        "wall_seconds_runs": [run["wall_seconds"] for run in runs],
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "setup_rss_mb": max(run["setup_rss_mb"] for run in runs),
+    }
+
+def environment():
+    """Describes the machine, library versions and settings the results were measured with."""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ndvi_calc.BASE_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "numexpr": ndvi_calc.USE_NUMEXPR,
+        "tile_memory_mb": ndvi_calc.TILE_MEMORY_MB,
+        "index_storage": ndvi_calc.INDEX_STORAGE,
+        "output_profile": ndvi_calc.OUTPUT_PROFILE,
+    }
+
+def run_benchmarks(workdir, sizes, stages, repeat=1):
+    """Runs every stage on every size and returns the JSON report."""
+    results = []
+    for size in sizes:
+        paths = make_fixtures(workdir, size)
+        for stage in stages:
+            result = run_stage(stage, paths, repeat)
+            logging.info(f"{size} {stage}: {result['wall_seconds']:.3f} s, peak RSS {result['peak_rss_mb']} MB")
+            results.append(dict(size=size, height=SIZES[size][0], width=SIZES[size][1], stage=stage, **result))
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "environment": environment(), "repeat": repeat, "results": results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NDVI/SAVI analysis stages on synthetic scenes.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, the best wall time is reported")
+    parser.add_argument("--workdir", help="folder keeping the generated scenes between runs (default: a temporary folder)")
+    parser.add_argument("--output", help="file to write the JSON report to (default: stdout)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = run_benchmarks(Path(args.workdir or tmp).resolve(), args.sizes, args.stages, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
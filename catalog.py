@@ -0,0 +1,208 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+from rasterio.errors import RasterioIOError
+from rasterio.warp import transform_bounds
+
+import ndvi_calc
+import result_cache
+import sources
+
+DATA_FOLDER = sources.DATA_FOLDER
+CATALOG_PATH = result_cache.SCENE_CACHE_PATH / "catalog.json"
+CATALOG_REFRESH_SECONDS = ndvi_calc.config["catalog_refresh_seconds"]
+# Bounds are indexed in WGS84 so scenes of different UTM zones can be compared
+INDEX_CRS = "EPSG:4326"
+DATE_PATTERN = re.compile(r"(\d{4})[-:_]?(\d{2})[-:_]?(\d{2})")
+MTL_DATE_PATTERN = re.compile(r'DATE_ACQUIRED\s*=\s*"?(\d{4}-\d{2}-\d{2})')
+
+# Folder name -> scene entry, and the WGS84 bounds index over them; replaced whole on refresh
+_catalog = {"scenes": {}, "names": [], "bounds": np.zeros((0, 4))}
+_refreshed_at = None
+# Held by scans and checksum passes, so only one of them publishes at a time
+_refresh_lock = threading.Lock()
+# Thread running the latest background scan or checksum pass
+_scanner = None
+_scanner_lock = threading.Lock()
+
+def acquisition_date(name, tags):
+    """Returns the ISO acquisition date from a Landsat MTL file, the scene name or the TIFF tags, else None."""
+    match = MTL_DATE_PATTERN.search(sources.mtl_text(name) or "")
+    if match:
+        return match.group(1)
+    # Landsat product ids hold the path/row before the date, so every candidate is tried
+    for text in (name, tags.get("TIFFTAG_DATETIME", "")):
+        for match in DATE_PATTERN.finditer(text):
+            try:
+                return datetime.date(*map(int, match.groups())).isoformat()
+            except ValueError:
+                pass
+    return None
+
+def read_scene(name, bands):
+    """Reads the metadata of a scene folder; its checksum is left to fill_checksums."""
+    band_paths = list(ndvi_calc.scene_band_paths(name).values())
+    with ExitStack() as stack:
+        first, *others = [stack.enter_context(rasterio.open(path)) for path in band_paths]
+        if any((src.width, src.height) != (first.width, first.height) for src in others):
+            raise ValueError(f"Bands of {name} have different sizes")
+        tags, crs, bounds = first.tags(), first.crs, list(first.bounds)
+        scene = {"crs": crs.to_string() if crs else None, "bounds": bounds, "width": first.width, "height": first.height,
+                 "dtype": first.dtypes[0], "transform": list(first.transform)[:6]}
+
+    scene.update(
+        name=name,
+        bands=bands,
+        wgs84_bounds=list(transform_bounds(crs, INDEX_CRS, *bounds)) if crs else None,
+        acquired=acquisition_date(name, tags),
+        checksum=None,
+    )
+    return scene
+
+def scene_checksum(name):
+    """Returns the sha256 over a scene's band checksums, or None if a band is remote."""
+    # Remote bands aren't downloaded whole for a checksum, their ETags identify them instead
+    checksums = [sources.file_checksum(path) for path in ndvi_calc.scene_band_paths(name).values()]
+    return None if None in checksums else hashlib.sha256("".join(checksums).encode()).hexdigest()
+
+def load_catalog():
+    try:
+        with open(CATALOG_PATH, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_catalog(scenes):
+    CATALOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    staging = CATALOG_PATH.with_name(f".{CATALOG_PATH.name}-{os.getpid()}-{threading.get_ident()}")
+    with open(staging, 'w') as f:
+        json.dump(scenes, f)
+    os.replace(staging, CATALOG_PATH)
+
+def publish(scenes, previous):
+    """Swaps in a new snapshot of the catalog, saving it if it changed."""
+    global _catalog
+    indexed = [name for name in scenes if scenes[name]["wgs84_bounds"]]
+    _catalog = {"scenes": scenes, "names": indexed, "bounds": np.array([scenes[name]["wgs84_bounds"] for name in indexed]).reshape(-1, 4)}
+    if scenes != previous:
+        save_catalog(scenes)
+
+def scan(force=False, checksums=True):
+    """Rescans the input folder, re-reading only the scenes whose bands changed since the last scan.
+
+    Unless forced, a snapshot younger than catalog_refresh_seconds is kept. Entries persist in the
+    scene cache folder, so a restart only stats the bands.
+    """
+    global _refreshed_at
+    with _refresh_lock:
+        if not force and _refreshed_at is not None and time.monotonic() - _refreshed_at < CATALOG_REFRESH_SECONDS:
+            return
+        previous = _catalog["scenes"] if _refreshed_at is not None else load_catalog()
+        scenes = {}
+        for name in sources.list_scenes(DATA_FOLDER):
+            try:
+                bands = [sources.band_identity(path) for path in ndvi_calc.scene_band_paths(name).values()]
+            except FileNotFoundError:
+                # Not a scene, or a remote one that is unreachable
+                continue
+            if name in previous and previous[name]["bands"] == bands:
+                scenes[name] = previous[name]
+                continue
+            try:
+                scenes[name] = read_scene(name, bands)
+            except (RasterioIOError, ValueError):
+                continue
+        publish(scenes, previous)
+        _refreshed_at = time.monotonic()
+    if checksums:
+        fill_checksums()
+
+def fill_checksums():
+    """Hashes the bands of the catalogued scenes without a checksum yet, then publishes them."""
+    with _refresh_lock:
+        previous = _catalog["scenes"]
+        scenes = dict(previous)
+        for name, scene in previous.items():
+            if scene["checksum"] is not None:
+                continue
+            try:
+                checksum = scene_checksum(name)
+            except OSError:
+                continue
+            if checksum is not None:
+                scenes[name] = dict(scene, checksum=checksum)
+        publish(scenes, previous)
+
+def in_background(target):
+    """Runs target on the background scan thread, unless a scan is already running there."""
+    global _scanner
+    with _scanner_lock:
+        if _scanner is None or not _scanner.is_alive():
+            _scanner = threading.Thread(target=target, daemon=True)
+            _scanner.start()
+
+def refresh(force=False):
+    """Brings the catalog up to date for a lookup.
+
+    Forced refreshes (the CLIs) scan and hash the bands on the calling thread. Otherwise requests
+    never wait on a rescan: the first lookup of a process reads the scenes' metadata and leaves
+    their checksums to a background thread, and a snapshot older than catalog_refresh_seconds
+    keeps being served while the background thread rescans.
+    """
+    if force:
+        scan(force=True)
+    elif _refreshed_at is None:
+        scan(checksums=False)
+        in_background(fill_checksums)
+    elif time.monotonic() - _refreshed_at >= CATALOG_REFRESH_SECONDS:
+        in_background(scan)
+
+def list_scenes():
+    """Returns the catalog entries sorted by acquisition date, then name; scenes without a date come last."""
+    refresh()
+    return sorted(_catalog["scenes"].values(), key=lambda scene: (scene["acquired"] is None, scene["acquired"] or "", scene["name"]))
+
+def get_scene(name):
+    """Returns the catalog entry of a scene folder, or raises FileNotFoundError."""
+    refresh()
+    scene = _catalog["scenes"].get(name)
+    if scene is None:
+        raise FileNotFoundError(f"Scene not found: {name}")
+    return scene
+
+def intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def overlap(old, new):
+    """Returns whether two catalog entries overlap, in their own CRS when they share one."""
+    if old["crs"] and old["crs"] == new["crs"]:
+        return intersects(old["bounds"], new["bounds"])
+    return bool(old["wgs84_bounds"] and new["wgs84_bounds"]) and intersects(old["wgs84_bounds"], new["wgs84_bounds"])
+
+def overlapping(bounds=None, scene=None, crs=INDEX_CRS):
+    """Returns the names of the scenes intersecting bounds (in crs), or another scene, from the index alone."""
+    refresh()
+    catalog = _catalog
+    if scene is not None:
+        entry = get_scene(scene)
+        return [name for name in catalog["names"] if name != scene and overlap(entry, catalog["scenes"][name])]
+    if crs != INDEX_CRS:
+        bounds = transform_bounds(crs, INDEX_CRS, *bounds)
+    left, bottom, right, top = bounds
+    boxes = catalog["bounds"]
+    hits = (boxes[:, 0] < right) & (left < boxes[:, 2]) & (boxes[:, 1] < top) & (bottom < boxes[:, 3])
+    return [catalog["names"][i] for i in np.flatnonzero(hits)]
+
+def check_pair(start_folder, end_folder):
+    """Raises FileNotFoundError if either scene is unknown, or ValueError if they don't overlap."""
+    old, new = get_scene(start_folder), get_scene(end_folder)
+    if not overlap(old, new):
+        raise ValueError(f"Scenes {start_folder} and {end_folder} do not overlap")
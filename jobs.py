@@ -0,0 +1,92 @@
+import atexit
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+with open(Path(__file__).resolve().parent / 'config.json', 'r') as f:
+    config = json.load(f)
+
+MAX_QUEUED_JOBS = config["max_queued_jobs"]
+JOB_RETENTION_SECONDS = config["job_retention_seconds"]
+FINISHED = ("done", "failed")
+
+# Warm pool running analyses and baseline updates in-process, bounded by analysis_workers
+executor = ThreadPoolExecutor(max_workers=config["analysis_workers"])
+atexit.register(executor.shutdown)
+
+_jobs = {}
+# Dedup key -> id of the queued or running job computing it
+_in_flight = {}
+# Notified on every job status change
+_changed = threading.Condition()
+
+class QueueFullError(RuntimeError):
+    pass
+
+def _snapshot(job):
+    return dict(job)
+
+def _prune():
+    """Forgets finished jobs older than the retention period."""
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    for job_id in [job_id for job_id, job in _jobs.items() if job["status"] in FINISHED and job["finished_at"] < cutoff]:
+        del _jobs[job_id]
+
+def _set(job, **fields):
+    with _changed:
+        job.update(fields)
+        if job["status"] in FINISHED:
+            job["finished_at"] = time.time()
+            _in_flight.pop(job["key"], None)
+        _changed.notify_all()
+
+def _run(job, fn, args):
+    _set(job, status="running", started_at=time.time())
+    try:
+        result = fn(*args)
+    except Exception as e:
+        _set(job, status="failed", error=str(e))
+    else:
+        _set(job, status="done", result=result)
+
+def submit(key, fn, *args):
+    """Queues fn(*args) and returns the job, or the identical in-flight job for key.
+
+    Raises QueueFullError when max_queued_jobs jobs are already queued or running.
+    """
+    with _changed:
+        _prune()
+        if key in _in_flight:
+            return _snapshot(_jobs[_in_flight[key]])
+        if len(_in_flight) >= MAX_QUEUED_JOBS:
+            raise QueueFullError(f"Too many jobs in progress ({MAX_QUEUED_JOBS}), try again later")
+
+        job = {"id": uuid.uuid4().hex, "key": key, "status": "queued", "submitted_at": time.time(), "started_at": None, "finished_at": None}
+        _jobs[job["id"]] = job
+        _in_flight[key] = job["id"]
+
+    executor.submit(_run, job, fn, args)
+    return _snapshot(job)
+
+def get(job_id):
+    with _changed:
+        job = _jobs.get(job_id)
+        return job and _snapshot(job)
+
+def in_flight():
+    """Returns the number of queued and of running jobs."""
+    with _changed:
+        statuses = [_jobs[job_id]["status"] for job_id in _in_flight.values()]
+    return {"queued": statuses.count("queued"), "running": statuses.count("running")}
+
+def wait(job_id, timeout=None, status=None):
+    """Blocks until the job leaves status (or finishes, if status is None) and returns it."""
+    with _changed:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        _changed.wait_for(lambda: job["status"] in FINISHED or (status is not None and job["status"] != status), timeout)
+        return _snapshot(job)
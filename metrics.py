@@ -0,0 +1,71 @@
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Name -> (type, help) of every exported metric
+METRICS = {
+    "ndvi_http_request_duration_seconds": ("histogram", "HTTP request latency by endpoint, method and status."),
+    "ndvi_analysis_duration_seconds": ("histogram", "Duration of analysis jobs, by whether the result cache was hit."),
+    "ndvi_baseline_duration_seconds": ("histogram", "Duration of baseline update jobs."),
+    "ndvi_stage_duration_seconds_total": ("counter", "Time spent in each analysis stage, summed over threads."),
+    "ndvi_stage_read_bytes_total": ("counter", "Decoded raster bytes read by each analysis stage."),
+    "ndvi_stage_written_bytes_total": ("counter", "File bytes written by each analysis stage."),
+    "ndvi_cache_requests_total": ("counter", "Result, scene and tile cache lookups by outcome."),
+    "ndvi_jobs": ("gauge", "Analysis and baseline jobs currently queued or running."),
+    "ndvi_process_peak_rss_bytes": ("gauge", "Peak resident set size of the server process."),
+}
+
+# (name, sorted label items) -> value, or [bucket counts, sum, count] for histograms
+_values = {}
+_lock = threading.Lock()
+
+def inc(name, value=1, **labels):
+    """Adds value to a counter."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Records one observation in a histogram."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _values.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+        # Buckets are cumulative, as Prometheus exports them
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def render(gauges=None):
+    """Returns every metric in the Prometheus text exposition format.
+
+    gauges lists (name, labels dict, value) samples taken at scrape time, e.g. the queue depth.
+    """
+    with _lock:
+        values = {key: [list(value[0]), value[1], value[2]] if isinstance(value, list) else value for key, value in _values.items()}
+    for name, labels, value in gauges or []:
+        values[(name, tuple(sorted(labels.items())))] = value
+
+    lines = []
+    for metric, (metric_type, help_text) in METRICS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {metric_type}"]
+        for (name, labels), value in sorted(values.items()):
+            if name != metric:
+                continue
+            if metric_type != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, value[0]):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[2]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {value[2]}")
+    return "\n".join(lines) + "\n"
@@ -1,91 +1,908 @@
+import ast
 import rasterio
 import numpy as np
 import time
 import json
+import math
 import sys
 from pathlib import Path  
 import cv2
+from rasterio import windows
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+import rasterio.shutil
+from affine import Affine
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import os
+import resource
+import shutil
+import result_cache
+import sources
 
-start_folder = Path(sys.argv[1])
-end_folder = Path(sys.argv[2])
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
-def save_as_png(data, output_png_path):
-    min_val, max_val = np.nanmin(data), np.nanmax(data)
-    normalized = ((data - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-    cv2.imwrite(str(output_png_path), normalized)
+# numexpr's gain over the fused numpy kernel comes from its thread pool, on one core it is slower
+USE_NUMEXPR = numexpr is not None and (os.cpu_count() or 1) > 1
 
-def compute_indices(red_band_path, nir_band_path, output_ndvi_path, output_savi_path, ndvi_png_path, savi_png_path, L=0.5):
-    with rasterio.open(red_band_path, mmap=True, num_threads="all_cpus") as red_src, \
-         rasterio.open(nir_band_path, mmap=True, num_threads="all_cpus") as nir_src:
-        red = red_src.read(1).astype(np.float32)
-        nir = nir_src.read(1).astype(np.float32)
+with open(Path(__file__).resolve().parent / 'config.json', 'r') as f:
+    config = json.load(f)
+
+BASE_PATH = Path(__file__).resolve().parent
+L = config["L"]
+DEFORESTATION_ALERT_THRESHOLD = config["deforestation_alert_threshold"]
+# Index name -> expression over the bands named in config["bands"] and L, see compile_kernel
+INDEX_EXPRESSIONS = {name: index["expression"] for name, index in config["indices"].items()}
+# Index name -> change threshold; a pixel is deforested where every one of these indices dropped below its threshold
+CHANGE_THRESHOLDS = {name: index["change_threshold"] for name, index in config["indices"].items() if index.get("change_threshold") is not None}
+if not CHANGE_THRESHOLDS:
+    raise ValueError("At least one index needs a change_threshold")
+# Every parameter that changes the analysis output, used to key cached results
+ANALYSIS_PARAMS = {
+    "L": L,
+    **{f"{name}_threshold": threshold for name, threshold in CHANGE_THRESHOLDS.items()},
+    "deforestation_alert_threshold": DEFORESTATION_ALERT_THRESHOLD,
+}
+TILE_MEMORY_MB = config["tile_memory_mb"]
+OUTPUT_PROFILE = config["output_profile"]
+QUICKLOOK_MAX_DIM = config["quicklook_max_dim"]
+QUICKLOOK_SAMPLE_SIZE = 100000
+# ColorBrewer RdYlGn anchors, from bare soil/loss (red) to dense vegetation/gain (green)
+QUICKLOOK_COLORS = [(165, 0, 38), (244, 109, 67), (254, 224, 139), (217, 239, 139), (102, 189, 99), (0, 104, 55)]
+# "float32", or "int16" for indices stored as value / INDEX_SCALE with an INDEX_NODATA sentinel
+INDEX_STORAGE = config["index_storage"]
+if INDEX_STORAGE not in ("float32", "int16"):
+    raise ValueError(f"Unsupported index_storage: {INDEX_STORAGE}")
+# Indices lie in about [-1.5, 1.5] and changes in [-3, 3], so 1e-4 steps still fit in int16
+INDEX_SCALE = 1e-4
+INDEX_NODATA = -32768
+STORAGE_SCALE = INDEX_SCALE if INDEX_STORAGE == "int16" else None
+# Change detection holds an old and new tile and a change per thresholded index, the deforestation mask and its patch labels per pixel
+CHANGE_BYTES_PER_PIXEL = 12 * len(CHANGE_THRESHOLDS) + 8
+WRITE_INTERMEDIATE_RASTERS = config["write_intermediate_rasters"]
+# Side, in pixels, of the cells the deforestation mask is summarized into, and how many hotspots are listed
+HOTSPOT_CELL_PIXELS = config["hotspot_cell_pixels"]
+HOTSPOT_TOP_K = config["hotspot_top_k"]
+HOTSPOTS_FILE = "hotspots.json"
+# Settings besides the analysis parameters that change a scene's cached products, folded into its cache key
+SCENE_OUTPUT_SETTINGS = {"quicklook_max_dim": QUICKLOOK_MAX_DIM, "index_storage": INDEX_STORAGE, "indices": INDEX_EXPRESSIONS}
+# And those that change a pair's cached result files
+ANALYSIS_OUTPUT_SETTINGS = dict(SCENE_OUTPUT_SETTINGS, hotspot_cell_pixels=HOTSPOT_CELL_PIXELS, hotspot_top_k=HOTSPOT_TOP_K,
+                                write_intermediate_rasters=WRITE_INTERMEDIATE_RASTERS)
+
+def output_meta(meta):
+    """Returns meta with the configured internal tiling and compression for a GeoTIFF output."""
+    meta = dict(meta, driver="GTiff", tiled=True, blockxsize=OUTPUT_PROFILE["blocksize"], blockysize=OUTPUT_PROFILE["blocksize"])
+    if OUTPUT_PROFILE["compress"]:
+        meta["compress"] = OUTPUT_PROFILE["compress"]
+        if OUTPUT_PROFILE["predictor"]:
+            # Floating-point predictor for the index rasters, horizontal differencing for integers
+            meta["predictor"] = 3 if np.issubdtype(np.dtype(meta["dtype"]), np.floating) else 2
+    return meta
+
+def overview_factors(width, height, blocksize=OUTPUT_PROFILE["blocksize"]):
+    """Returns overview decimation factors down to the first level that fits in one block."""
+    factors = []
+    while max(width, height) / 2 ** len(factors) > blocksize:
+        factors.append(2 ** (len(factors) + 1))
+    return factors
+
+def index_meta(meta, scale=STORAGE_SCALE):
+    """Returns meta for an index or change raster, scaled int16 when scale is set, float32 otherwise."""
+    if scale:
+        return dict(meta, dtype=rasterio.int16, nodata=INDEX_NODATA, count=1)
+    return dict(meta, dtype=rasterio.float32, count=1)
+
+def storage_scale(src):
+    """Returns the scale of a scaled int16 index raster, or None for a float raster."""
+    if src.dtypes[0] == "int16" and src.nodata == INDEX_NODATA:
+        return src.scales[0]
+    return None
+
+def encode_index(data, scale=STORAGE_SCALE):
+    """Converts float index values to the storage representation, NaN becoming INDEX_NODATA."""
+    if not scale:
+        return data
+    valid = np.isfinite(data)
+    encoded = np.full(data.shape, INDEX_NODATA, dtype=np.int16)
+    encoded[valid] = np.clip(np.rint(data[valid] / scale), -32767, 32767)
+    return encoded
+
+def decode_index(data, scale):
+    """Converts stored index values back to float32, INDEX_NODATA becoming NaN."""
+    if not scale:
+        return data
+    decoded = data.astype(np.float32) * np.float32(scale)
+    decoded[data == INDEX_NODATA] = np.nan
+    return decoded
+
+def scaled_threshold(threshold, scale):
+    """Converts a threshold into the scaled integer domain: value * scale < threshold <=> value < result."""
+    return math.ceil(round(threshold / scale, 6))
+
+def scaled_change(new, old):
+    """Subtracts two scaled int16 tiles, returning the int16 change with INDEX_NODATA where either is missing."""
+    change = np.subtract(new, old, dtype=np.int32)
+    np.clip(change, -32767, 32767, out=change)
+    change = change.astype(np.int16)
+    change[(new == INDEX_NODATA) | (old == INDEX_NODATA)] = INDEX_NODATA
+    return change
+
+def cog_options():
+    """Returns the COG driver creation options of output_profile."""
+    options = {"blocksize": OUTPUT_PROFILE["blocksize"], "overviews": "AUTO" if OUTPUT_PROFILE["overviews"] else "NONE",
+               "resampling": OUTPUT_PROFILE["overview_resampling"], "num_threads": "ALL_CPUS"}
+    if OUTPUT_PROFILE["compress"]:
+        options.update(compress=OUTPUT_PROFILE["compress"], predictor="YES" if OUTPUT_PROFILE["predictor"] else "NO")
+    return options
+
+@contextmanager
+def open_output(path, meta, scale=None, windowed=True):
+    """Opens a GeoTIFF output for (windowed) writing and finalizes its layout on close.
+
+    scale is recorded in the GeoTIFF metadata of scaled int16 rasters. The file gets
+    internal tiles, compression and overviews per output_profile. With cog enabled, the
+    COG driver can't be written to window by window, so windowed outputs are written to a
+    temporary GeoTIFF and copied into Cloud Optimized GeoTIFF layout: every such output is
+    written and compressed twice. Outputs written whole in one call can pass windowed=False
+    to go straight through the COG driver, which buffers the raster in memory instead.
+    """
+    path = Path(path)
+    cog = OUTPUT_PROFILE["cog"]
+    if cog and not windowed:
+        with rasterio.open(path, 'w', **dict(meta, driver="COG"), **cog_options()) as dst:
+            if scale:
+                dst.scales, dst.offsets = (scale,), (0.0,)
+            yield dst
+        return
+
+    write_path = path.with_name(path.name + ".tmp") if cog else path
+    try:
+        with rasterio.open(write_path, 'w', **output_meta(meta), num_threads="all_cpus") as dst:
+            if scale:
+                dst.scales, dst.offsets = (scale,), (0.0,)
+            yield dst
+            if OUTPUT_PROFILE["overviews"] and not cog:
+                dst.build_overviews(overview_factors(dst.width, dst.height), Resampling[OUTPUT_PROFILE["overview_resampling"]])
+                dst.update_tags(ns="rio_overview", resampling=OUTPUT_PROFILE["overview_resampling"])
+
+        if cog:
+            rasterio.shutil.copy(write_path, path, driver="COG", **cog_options())
+    finally:
+        if cog:
+            write_path.unlink(missing_ok=True)
+
+def tile_windows(src, tile_memory_mb=TILE_MEMORY_MB, bytes_per_pixel=None, height=None, width=None):
+    """Yields block-aligned windows covering the top-left height x width of src, each fitting in tile_memory_mb.
+
+    bytes_per_pixel is the working set per pixel, the index kernel's by default.
+    """
+    height, width = height or src.height, width or src.width
+    bytes_per_pixel = bytes_per_pixel or KERNEL["bytes_per_pixel"]
+    if not tile_memory_mb:
+        yield Window(0, 0, width, height)
+        return
+
+    block_height, block_width = src.block_shapes[0]
+    # Align to the output tiles too, so no compressed output block is written twice
+    row_align = math.lcm(block_height, OUTPUT_PROFILE["blocksize"])
+    tile_rows, tile_cols = int(tile_memory_mb * 1024 * 1024 // bytes_per_pixel) // width, width
+    if tile_rows < row_align:
+        # Not even one aligned row of blocks fits, fall back to the native blocks
+        tile_rows, tile_cols = block_height, block_width
+    else:
+        tile_rows -= tile_rows % row_align
+
+    for row_off in range(0, height, tile_rows):
+        for col_off in range(0, width, tile_cols):
+            yield Window(col_off, row_off, min(tile_cols, width - col_off), min(tile_rows, height - row_off))
+
+def colormap_lut(colors):
+    """Interpolates RGB anchor colors into a 256-entry BGRA lookup table."""
+    colors = np.asarray(colors, dtype=np.float32)
+    anchors, positions = np.linspace(0, 255, len(colors)), np.arange(256)
+    bgr = [np.interp(positions, anchors, colors[:, channel]) for channel in (2, 1, 0)]
+    return np.dstack(bgr + [np.full(256, 255)])[0].round().astype(np.uint8)
+
+COLORMAP_LUT = colormap_lut(QUICKLOOK_COLORS)
+
+def colorize(data, min_val, max_val):
+    """Maps float data through COLORMAP_LUT into a BGRA image, with NaN pixels transparent."""
+    valid = np.isfinite(data)
+    scaled = np.zeros(data.shape, dtype=np.uint8)
+    scaled[valid] = np.clip((data[valid] - min_val) * (255 / (max_val - min_val)), 0, 255)
+    image = COLORMAP_LUT[scaled]
+    image[~valid, 3] = 0
+    return image
+
+def robust_range(data, sample_size=QUICKLOOK_SAMPLE_SIZE):
+    """Returns the 2nd-98th percentile stretch of data, taken from an even sample of its valid pixels."""
+    valid = data[np.isfinite(data)]
+    if valid.size == 0:
+        return 0.0, 1.0
+    low, high = np.percentile(valid[::max(valid.size // sample_size, 1)], [2, 98])
+    return float(low), float(max(high, low + 1e-6))
+
+def save_quicklook(raster_path, output_png_path, max_dim=QUICKLOOK_MAX_DIM):
+    """Saves a colorized PNG quicklook of a raster, at most max_dim pixels on its longest side.
+
+    The decimated read is served from the raster's overviews, so the full resolution is never
+    loaded. Returns the stretch used, so map tiles can be drawn the same way.
+    """
+    with rasterio.open(raster_path, num_threads="all_cpus") as src:
+        scale = min(max_dim / max(src.width, src.height), 1)
+        data = src.read(1, out_shape=(max(round(src.height * scale), 1), max(round(src.width * scale), 1)))
+        data = decode_index(data, storage_scale(src))
+    value_range = robust_range(data)
+    cv2.imwrite(str(output_png_path), colorize(data, *value_range))
+    return value_range
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB."""
+    # Linux keeps ru_maxrss across exec, so a spawned worker would report its parent's peak; VmHWM starts afresh
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+def new_timings():
+    """Returns an empty record for the pipeline functions taking timings= to fill."""
+    return {"stages": {}, "cache": {}}
+
+def add_timing(timings, stage, seconds, bytes_read=0, bytes_written=0, peak_mb=0.0):
+    """Accumulates the duration and I/O of a pipeline stage into timings, if given.
+
+    Called once per tile, so it doesn't sample memory; see record_peaks.
+    """
+    if timings is None:
+        return
+    entry = timings["stages"].setdefault(stage, {"seconds": 0.0, "bytes_read": 0, "bytes_written": 0, "process_peak_rss_mb": 0.0})
+    entry["seconds"] += seconds
+    entry["bytes_read"] += bytes_read
+    entry["bytes_written"] += bytes_written
+    entry["process_peak_rss_mb"] = max(entry["process_peak_rss_mb"], peak_mb)
+
+def record_peaks(timings, *stages):
+    """Samples the peak RSS once as the given stages of timings end, into their process_peak_rss_mb.
+
+    The peak is the whole process's high-water mark: it includes everything run before in the
+    process and any concurrent jobs, so only a stage whose value jumps over the previous
+    one's points at where memory was spent.
+    """
+    if timings is None:
+        return
+    peak = peak_rss_mb()
+    for stage in stages:
+        if stage in timings["stages"]:
+            add_timing(timings, stage, 0, peak_mb=peak)
+
+def count_cache(timings, cache, hit):
+    """Counts a cache lookup into timings, if given."""
+    if timings is None:
+        return
+    counts = timings["cache"].setdefault(cache, {"hit": 0, "miss": 0})
+    counts["hit" if hit else "miss"] += 1
+
+def merge_timings(timings, other):
+    """Adds the stages and cache lookups of other into timings."""
+    for stage, entry in other["stages"].items():
+        add_timing(timings, stage, entry["seconds"], entry["bytes_read"], entry["bytes_written"], entry["process_peak_rss_mb"])
+    for cache, counts in other["cache"].items():
+        merged = timings["cache"].setdefault(cache, {"hit": 0, "miss": 0})
+        for outcome, count in counts.items():
+            merged[outcome] += count
+
+def file_sizes(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+# Arithmetic allowed in index expressions, and the ufuncs the kernel runs it with
+KERNEL_OPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.USub: np.negative}
+# Scalars index expressions may use besides the bands, given per call
+KERNEL_PARAMS = ("L",)
+
+def parse_expression(expression, bands):
+    """Parses an index expression into nested (op, operand...) tuples over band and parameter names and floats.
+
+    Raises ValueError for anything but + - * / and unary minus on names and numbers.
+    """
+    def node(tree):
+        if isinstance(tree, ast.BinOp) and type(tree.op) in KERNEL_OPS:
+            return (type(tree.op), node(tree.left), node(tree.right))
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.USub):
+            return (ast.USub, node(tree.operand))
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.UAdd):
+            return node(tree.operand)
+        if isinstance(tree, ast.Name) and (tree.id in bands or tree.id in KERNEL_PARAMS):
+            return tree.id
+        if isinstance(tree, ast.Constant) and type(tree.value) in (int, float):
+            return float(tree.value)
+        raise ValueError(f"Unsupported term {ast.unparse(tree)!r} in index expression {expression!r}")
+
+    try:
+        return node(ast.parse(expression, mode="eval").body)
+    except SyntaxError as e:
+        raise ValueError(f"Invalid index expression {expression!r}: {e.msg}")
+
+def uses_band(node, bands):
+    if isinstance(node, tuple):
+        return any(uses_band(operand, bands) for operand in node[1:])
+    return node in bands
+
+def scalar_value(node, params):
+    """Evaluates a band-free expression node in double precision, like Python would."""
+    if isinstance(node, float):
+        return node
+    if isinstance(node, str):
+        return params[node]
+    operands = [scalar_value(operand, params) for operand in node[1:]]
+    return float(KERNEL_OPS[node[0]](*operands))
+
+def compile_kernel(expressions, bands=sources.BAND_NUMBERS):
+    """Compiles index expressions into one kernel: a list of ufunc steps over reusable tile buffers.
+
+    Subexpressions shared between indices (e.g. nir - red) are computed once, band-free
+    subexpressions (e.g. 1 + L) are folded into scalars, and a buffer is reused as soon as the
+    value in it is dead, bands included. Returns the bands to read, the buffer names, the steps
+    and the working set per pixel for tile_windows.
+    """
+    trees = {name: parse_expression(expression, bands) for name, expression in expressions.items()}
+    overlap = set(trees) & (set(bands) | set(KERNEL_PARAMS))
+    if overlap:
+        raise ValueError(f"Index names clash with band or parameter names: {sorted(overlap)}")
+
+    steps, values, used_bands = [], {}, []
+
+    def emit(node):
+        # Operands are band names, "#<step>" values, or ("scalar", node) for band-free nodes
+        if not uses_band(node, bands):
+            return ("scalar", node)
+        if isinstance(node, str):
+            if node not in used_bands:
+                used_bands.append(node)
+            return node
+        if node not in values:
+            operands = [emit(operand) for operand in node[1:]]
+            values[node] = f"#{len(steps)}"
+            steps.append([KERNEL_OPS[node[0]], values[node], *operands])
+        return values[node]
+
+    roots = {name: emit(tree) for name, tree in trees.items()}
+    # Each index lands in its own output buffer; roots that are bands, scalars or shared get a copy
+    for name in trees:
+        root = roots[name]
+        if isinstance(root, str) and root.startswith("#"):
+            # Computed into the output buffer directly
+            for step in steps:
+                step[1:] = [name if operand == root else operand for operand in step[1:]]
+            roots = {index: name if value == root else value for index, value in roots.items()}
+        else:
+            steps.append([np.positive, name, root])
+
+    # Linear scan: a step may write into a buffer one of its own operands dies in
+    last_use = {}
+    for i, step in enumerate(steps):
+        for operand in step[2:]:
+            if isinstance(operand, str):
+                last_use[operand] = i
+    physical, free, buffers = {band: band for band in used_bands}, [], list(used_bands) + list(trees)
+    physical.update({name: name for name in trees})
+    for i, step in enumerate(steps):
+        operands = [physical[operand] if isinstance(operand, str) else operand for operand in step[2:]]
+        for operand in dict.fromkeys(operand for operand in step[2:] if isinstance(operand, str)):
+            if last_use[operand] == i and operand not in trees:
+                free.append(physical[operand])
+        if step[1] not in physical:
+            if not free:
+                free.append(f"~{len(buffers)}")
+                buffers.append(free[-1])
+            physical[step[1]] = free.pop()
+        step[1:] = [physical[step[1]], *operands]
+
+    return {
+        "bands": used_bands,
+        "indices": list(trees),
+        "expressions": dict(expressions),
+        "buffers": buffers,
+        "steps": [tuple(step) for step in steps],
+        # float32 buffers, plus the encoded outputs and write slack
+        "bytes_per_pixel": 4 * len(buffers) + 4 * len(trees) + 4,
+    }
+
+def kernel_buffers(kernel, pixels):
+    """Preallocates the flat float32 buffers a kernel works in, for tiles of up to pixels pixels."""
+    return {name: np.empty(pixels, dtype=np.float32) for name in kernel["buffers"]}
+
+def tile_buffers(buffers, height, width):
+    """Returns views of the kernel buffers shaped like a height x width tile."""
+    return {name: buffer[:height * width].reshape(height, width) for name, buffer in buffers.items()}
+
+def run_kernel(kernel, out, L=L):
+    """Computes every index of a kernel from the band tiles in out, into out[index].
+
+    Band buffers may be overwritten. With numexpr on a multi-core machine, each index is
+    evaluated in a single blocked, threaded pass instead.
+    """
+    params = {"L": L}
+    if USE_NUMEXPR:
+        local_dict = {band: out[band] for band in kernel["bands"]}
+        local_dict.update({name: np.float32(value) for name, value in params.items()})
+        for name, expression in kernel["expressions"].items():
+            numexpr.evaluate(expression, local_dict=local_dict, out=out[name], casting="same_kind")
+        return {name: out[name] for name in kernel["indices"]}
+
+    for ufunc, target, *operands in kernel["steps"]:
+        values = [out[operand] if isinstance(operand, str) else np.float32(scalar_value(operand[1], params)) for operand in operands]
+        ufunc(*values, out=out[target])
+    return {name: out[name] for name in kernel["indices"]}
+
+KERNEL = compile_kernel(INDEX_EXPRESSIONS)
+
+def compute_indices(band_paths, output_folder, L=L, tile_memory_mb=TILE_MEMORY_MB, timings=None, kernel=KERNEL):
+    """Computes every index of a kernel for a scene into <index>.tif and <index>.png in output_folder.
+
+    band_paths maps the kernel's bands to their rasters. Each band is read once per window and
+    shared by all indices, so an extra index only costs arithmetic. Returns the quicklook
+    stretch of each index as <index>_range.
+    """
+    output_folder = Path(output_folder)
+    with ExitStack() as stack:
+        band_srcs = {band: stack.enter_context(rasterio.open(band_paths[band], mmap=True, num_threads="all_cpus")) for band in kernel["bands"]}
+        ref = band_srcs[kernel["bands"][0]]
+        meta = index_meta(ref.meta)
 
         np.seterr(divide='ignore', invalid='ignore')
-        ndvi = (nir - red) / (nir + red)
-        savi = ((nir - red) / (nir + red + L)) * (1 + L)
 
-        meta = red_src.meta
-        meta.update(dtype=rasterio.float32, count=1)
+        # Stream tile by tile so peak memory is bounded by tile_memory_mb, not the scene size
+        with ExitStack() as outputs:
+            dsts = {name: outputs.enter_context(open_output(output_folder / f"{name}.tif", meta, STORAGE_SCALE)) for name in kernel["indices"]}
+            windows = list(tile_windows(ref, tile_memory_mb, kernel["bytes_per_pixel"]))
+            buffers = kernel_buffers(kernel, max(window.height * window.width for window in windows))
+            for window in windows:
+                start = time.perf_counter()
+                # Bands are read straight into the reused float32 buffers
+                out = tile_buffers(buffers, window.height, window.width)
+                for band, src in band_srcs.items():
+                    src.read(1, window=window, out=out[band])
+                read_done = time.perf_counter()
+                results = run_kernel(kernel, out, L)
+                computed = time.perf_counter()
+
+                for name, data in results.items():
+                    dsts[name].write(encode_index(data), 1, window=window)
+                add_timing(timings, "read", read_done - start, bytes_read=len(band_srcs) * out[kernel["bands"][0]].nbytes)
+                add_timing(timings, "indices", computed - read_done)
+                add_timing(timings, "write", time.perf_counter() - computed)
+            closing = time.perf_counter()
+        # Closing the outputs builds their overviews and COG layout
+        add_timing(timings, "write", time.perf_counter() - closing, bytes_written=file_sizes(*(output_folder / f"{name}.tif" for name in kernel["indices"])))
+        record_peaks(timings, "read", "indices", "write")
+
+    start = time.perf_counter()
+    ranges = {f"{name}_range": save_quicklook(output_folder / f"{name}.tif", output_folder / f"{name}.png") for name in kernel["indices"]}
+    add_timing(timings, "quicklook", time.perf_counter() - start, bytes_written=file_sizes(*(output_folder / f"{name}.png" for name in kernel["indices"])))
+    record_peaks(timings, "quicklook")
+    return ranges
+
+def overlap_window(ref, others):
+    """Returns the window of ref's grid that every dataset covers, shrunk to whole pixels.
+
+    Raises ValueError when the footprints don't overlap.
+    """
+    left, bottom, right, top = ref.bounds
+    for src in others:
+        bounds = src.bounds if src.crs == ref.crs else transform_bounds(src.crs, ref.crs, *src.bounds)
+        left, bottom, right, top = max(left, bounds[0]), max(bottom, bounds[1]), min(right, bounds[2]), min(top, bounds[3])
+
+    window = windows.from_bounds(left, bottom, right, top, ref.transform) if left < right and bottom < top else None
+    if window is not None:
+        # Rounding first drops floating point noise, so exactly shared pixels are kept
+        col_start, row_start = math.ceil(round(window.col_off, 6)), math.ceil(round(window.row_off, 6))
+        col_end, row_end = math.floor(round(window.col_off + window.width, 6)), math.floor(round(window.row_off + window.height, 6))
+        if col_end > col_start and row_end > row_start:
+            return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+    raise ValueError("The rasters do not overlap")
 
-        with rasterio.open(output_ndvi_path, 'w', **meta, num_threads="all_cpus") as ndvi_dst:
-            ndvi_dst.write(ndvi, 1)
-        with rasterio.open(output_savi_path, 'w', **meta, num_threads="all_cpus") as savi_dst:
-            savi_dst.write(savi, 1)
-    
-    save_as_png(ndvi, ndvi_png_path)
-    save_as_png(savi, savi_png_path)
+def aligned_source(src, ref, window, stack):
+    """Returns a dataset and (row, col) offset from which window of ref's grid is read.
+
+    A dataset on the same grid as ref (same CRS and pixel size, shifted by whole pixels) is
+    read directly at an offset. Any other is resampled onto the window's grid through a
+    WarpedVRT, which is closed with stack.
+    """
+    origin = windows.transform(window, ref.transform)
+    col, row = (round(value) for value in ~src.transform * (origin.c, origin.f))
+    if src.crs == ref.crs and (src.transform * Affine.translation(col, row)).almost_equals(origin):
+        return src, (row, col)
+    vrt = stack.enter_context(WarpedVRT(src, crs=ref.crs, transform=origin, width=window.width, height=window.height,
+                                        nodata=np.nan if src.nodata is None else src.nodata, resampling=Resampling.bilinear))
+    return vrt, (0, 0)
+
+def read_aligned(aligned, window):
+    """Reads a window of the common grid from an aligned_source result."""
+    src, (row, col) = aligned
+    return src.read(1, window=Window(window.col_off + col, window.row_off + row, window.width, window.height))
 
 def compare_indices(old_path, new_path, output_change_path):
     with rasterio.open(old_path, mmap=True, num_threads="all_cpus") as old_src, \
-         rasterio.open(new_path, mmap=True, num_threads="all_cpus") as new_src:
-        old_data, new_data = old_src.read(1).astype(np.float32), new_src.read(1).astype(np.float32)
-        min_rows, min_cols = min(old_data.shape[0], new_data.shape[0]), min(old_data.shape[1], new_data.shape[1])
-        change = new_data[:min_rows, :min_cols] - old_data[:min_rows, :min_cols]
-        meta = old_src.meta
-        meta.update(dtype=rasterio.float32, count=1, height=min_rows, width=min_cols)
-        with rasterio.open(output_change_path, 'w', **meta, num_threads="all_cpus") as dst:
+         rasterio.open(new_path, mmap=True, num_threads="all_cpus") as new_src, \
+         ExitStack() as stack:
+        # Only the geographic overlap is read, on the old raster's grid
+        grid = overlap_window(old_src, [new_src])
+        full = Window(0, 0, grid.width, grid.height)
+        old_data = read_aligned(aligned_source(old_src, old_src, grid, stack), full)
+        new_data = read_aligned(aligned_source(new_src, old_src, grid, stack), full)
+
+        # Scaled int16 inputs are subtracted as integers and stay scaled
+        scale = storage_scale(old_src) if storage_scale(old_src) == storage_scale(new_src) else None
+        if scale:
+            change = scaled_change(new_data, old_data)
+        else:
+            change = decode_index(new_data, storage_scale(new_src)) - decode_index(old_data, storage_scale(old_src))
+        meta = index_meta(old_src.meta, scale)
+        meta.update(height=grid.height, width=grid.width, transform=windows.transform(grid, old_src.transform))
+        with open_output(output_change_path, meta, scale, windowed=False) as dst:
             dst.write(change, 1)
 
-def detect_deforestation(ndvi_change_path, savi_change_path, ndvi_threshold=-0.2, savi_threshold=-0.2):
-    with rasterio.open(ndvi_change_path, mmap=True, num_threads="all_cpus") as ndvi_src, \
-         rasterio.open(savi_change_path, mmap=True, num_threads="all_cpus") as savi_src:
-        ndvi_change, savi_change = ndvi_src.read(1), savi_src.read(1)
-        deforested_pixels = np.sum((ndvi_change < ndvi_threshold) & (savi_change < savi_threshold))
-        deforestation_percentage = round((deforested_pixels / ndvi_change.size) * 100, 2)
-        result = {
-            "deforestation_percentage": deforestation_percentage,
-            "status": "🚨 Significant deforestation detected!" if deforestation_percentage > 5 else "✅ No significant deforestation detected."
+def deforestation_result(deforested_pixels, total_pixels, alert_threshold=DEFORESTATION_ALERT_THRESHOLD):
+    deforestation_percentage = round((deforested_pixels / total_pixels) * 100, 2)
+    return {
+        "deforestation_percentage": deforestation_percentage,
+        "status": "🚨 Significant deforestation detected!" if deforestation_percentage > alert_threshold else "✅ No significant deforestation detected."
+    }
+
+def detect_deforestation(change_paths, thresholds=CHANGE_THRESHOLDS):
+    """Returns the deforestation result of change rasters, given as {index: path} for every index in thresholds."""
+    deforested = None
+    for name, threshold in thresholds.items():
+        with rasterio.open(change_paths[name], mmap=True, num_threads="all_cpus") as src:
+            change, scale = src.read(1), storage_scale(src)
+        # Thresholds move into the scaled domain, so detection on int16 changes stays integer
+        below = change < (scaled_threshold(threshold, scale) if scale else threshold)
+        if scale:
+            below &= valid_change(change, scale)
+        deforested = below if deforested is None else deforested & below
+    return deforestation_result(np.sum(deforested), deforested.size)
+
+def valid_change(change, scale):
+    """Returns where a change tile holds data: not INDEX_NODATA when scaled, finite otherwise."""
+    return change != INDEX_NODATA if scale else np.isfinite(change)
+
+def change_thresholds(params):
+    """Returns {index: change threshold} from analysis parameters such as ANALYSIS_PARAMS (ndvi_threshold, ...)."""
+    return {name: params[f"{name}_threshold"] for name in CHANGE_THRESHOLDS}
+
+@contextmanager
+def open_change(old_scene, new_scene, thresholds=CHANGE_THRESHOLDS, timings=None):
+    """Opens the index rasters of two scene folders for change detection over their overlap.
+
+    thresholds maps each index to compare to its change threshold; a pixel is deforested where
+    every index dropped below its threshold. Like compare_indices, the scenes are compared
+    over their geographic overlap on the first old index raster's grid, resampling inputs on
+    other grids. Yields a dict with that "grid" (a window of that raster), its "transform" and
+    "crs", the change raster "meta" and "scale", the "changes" names (<index>_change) and
+    "tiles", a function returning the change arrays and the deforested mask of a window of the grid.
+    """
+    with ExitStack() as stack:
+        open_index = lambda path: stack.enter_context(rasterio.open(path, mmap=True, num_threads="all_cpus"))
+        srcs = {(name, age): open_index(Path(scene) / f"{name}.tif") for name in thresholds for age, scene in (("old", old_scene), ("new", new_scene))}
+        ref = next(iter(srcs.values()))
+        grid = overlap_window(ref, list(srcs.values())[1:])
+
+        # When every input is scaled int16 alike, changes and thresholds stay in the integer domain
+        scales = {storage_scale(src) for src in srcs.values()}
+        scale = scales.pop() if len(scales) == 1 else None
+        if scale:
+            thresholds = {name: scaled_threshold(threshold, scale) for name, threshold in thresholds.items()}
+        subtract = scaled_change if scale else np.subtract
+        # Each input is read as (aligned source, scale to decode it with, if any)
+        inputs = {key: (aligned_source(src, ref, grid, stack), None if scale else storage_scale(src)) for key, src in srcs.items()}
+        read = lambda source, window: decode_index(read_aligned(source[0], window), source[1])
+        transform = windows.transform(grid, ref.transform)
+        meta = index_meta(ref.meta, scale)
+        meta.update(height=grid.height, width=grid.width, transform=transform)
+
+        def tiles(window):
+            start = time.perf_counter()
+            data = {key: read(source, window) for key, source in inputs.items()}
+            read_done = time.perf_counter()
+            change, deforested = {}, None
+            for name, threshold in thresholds.items():
+                change[f"{name}_change"] = subtract(data[name, "new"], data[name, "old"])
+                below = change[f"{name}_change"] < threshold
+                if scale:
+                    below &= valid_change(change[f"{name}_change"], scale)
+                deforested = below if deforested is None else np.logical_and(deforested, below, out=deforested)
+            change["deforested"] = deforested
+            add_timing(timings, "read", read_done - start, bytes_read=sum(tile.nbytes for tile in data.values()))
+            add_timing(timings, "change", time.perf_counter() - read_done)
+            return change
+
+        yield {"grid": grid, "transform": transform, "crs": ref.crs, "meta": meta, "scale": scale, "tiles": tiles, "src": ref,
+               "changes": [f"{name}_change" for name in thresholds]}
+
+def pixel_area_m2(crs, transform):
+    """Returns the area of a pixel in square metres, or None for a CRS without linear units."""
+    if not crs.is_projected:
+        return None
+    metres = crs.linear_units_factor[1]
+    return abs(transform.a * transform.e - transform.b * transform.d) * metres ** 2
+
+def new_hotspots(height, width, cell_pixels=HOTSPOT_CELL_PIXELS):
+    """Returns an empty hotspot accumulator for a height x width deforestation mask."""
+    return {
+        "height": height, "width": width, "cell_pixels": cell_pixels,
+        "cells": np.zeros((math.ceil(height / cell_pixels), math.ceil(width / cell_pixels)), dtype=np.int64),
+        # Per patch piece: pixel count and pixel bounding box (top, left, bottom, right)
+        "pieces": [], "next_id": 0,
+        # Pairs of piece ids touching across tile edges, joined into patches at the end
+        "joins": [],
+        # Piece ids along the bottom row of the previous tile row, and the right column of the previous tile
+        "bottom_row": np.full(width, -1, dtype=np.int64), "next_bottom_row": np.full(width, -1, dtype=np.int64),
+        "right_column": None, "tile_row": None,
+    }
+
+def edge_joins(labels, neighbours):
+    """Returns the (label, neighbour) id pairs of 8-connected pixels along an edge.
+
+    labels are the ids of the edge pixels, neighbours the ids of the adjacent line of pixels,
+    padded by one on each side; -1 is background.
+    """
+    joins = []
+    for shift in (0, 1, 2):
+        adjacent = neighbours[shift:shift + len(labels)]
+        touching = (labels >= 0) & (adjacent >= 0)
+        joins.append(np.stack([labels[touching], adjacent[touching]], axis=1))
+    return np.concatenate(joins)
+
+def add_hotspot_tile(hotspots, window, deforested):
+    """Adds a tile of the deforestation mask to the cell counts and the connected patches.
+
+    Tiles must come in tile_windows order (row by row, left to right).
+    """
+    cell = hotspots["cell_pixels"]
+    row_starts = np.unique(np.r_[0, np.arange(-window.row_off % cell, window.height, cell)])
+    col_starts = np.unique(np.r_[0, np.arange(-window.col_off % cell, window.width, cell)])
+    sums = np.add.reduceat(np.add.reduceat(deforested, col_starts, axis=1, dtype=np.int64), row_starts, axis=0)
+    cell_row, cell_col = window.row_off // cell, window.col_off // cell
+    hotspots["cells"][cell_row:cell_row + sums.shape[0], cell_col:cell_col + sums.shape[1]] += sums
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(deforested.view(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+    # Label 0 is the background; the others become global piece ids
+    offset = hotspots["next_id"] - 1
+    labels = np.where(labels > 0, labels.astype(np.int64) + offset, -1)
+    stats = stats[1:].astype(np.int64)
+    top, left = stats[:, cv2.CC_STAT_TOP] + window.row_off, stats[:, cv2.CC_STAT_LEFT] + window.col_off
+    hotspots["pieces"].append(np.stack([stats[:, cv2.CC_STAT_AREA], top, left, top + stats[:, cv2.CC_STAT_HEIGHT], left + stats[:, cv2.CC_STAT_WIDTH]], axis=1))
+    hotspots["next_id"] += count - 1
+
+    if hotspots["tile_row"] != window.row_off:
+        # A new row of tiles: the one above is complete
+        hotspots["bottom_row"], hotspots["next_bottom_row"] = hotspots["next_bottom_row"], hotspots["bottom_row"]
+        hotspots["tile_row"], hotspots["right_column"] = window.row_off, None
+    columns = slice(window.col_off, window.col_off + window.width)
+    if window.row_off > 0:
+        above = np.pad(hotspots["bottom_row"], 1, constant_values=-1)[window.col_off:window.col_off + window.width + 2]
+        hotspots["joins"].append(edge_joins(labels[0], above))
+    if hotspots["right_column"] is not None:
+        hotspots["joins"].append(edge_joins(labels[:, 0], np.pad(hotspots["right_column"], 1, constant_values=-1)))
+    hotspots["next_bottom_row"][columns] = labels[-1]
+    hotspots["right_column"] = labels[:, -1]
+
+def hotspot_summary(hotspots, transform, crs, top_k=HOTSPOT_TOP_K):
+    """Joins the patch pieces and returns the cell grid and the top_k cells and patches, georeferenced."""
+    pieces = np.concatenate(hotspots["pieces"]) if hotspots["pieces"] else np.zeros((0, 5), dtype=np.int64)
+    parent = np.arange(len(pieces))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for a, b in (np.concatenate(hotspots["joins"]) if hotspots["joins"] else []):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    while not np.array_equal(parent, parent[parent]):
+        parent = parent[parent]
+
+    roots, patch = np.unique(parent, return_inverse=True)
+    pixels = np.bincount(patch, weights=pieces[:, 0], minlength=len(roots)).astype(np.int64)
+    top, left = np.full(len(roots), np.iinfo(np.int64).max), np.full(len(roots), np.iinfo(np.int64).max)
+    bottom, right = np.zeros(len(roots), dtype=np.int64), np.zeros(len(roots), dtype=np.int64)
+    np.minimum.at(top, patch, pieces[:, 1])
+    np.minimum.at(left, patch, pieces[:, 2])
+    np.maximum.at(bottom, patch, pieces[:, 3])
+    np.maximum.at(right, patch, pieces[:, 4])
+
+    area = pixel_area_m2(crs, transform)
+    cell = hotspots["cell_pixels"]
+    cells = hotspots["cells"]
+
+    def region(row, col, height, width, count):
+        return {
+            "deforested_pixels": int(count),
+            "deforested_area_m2": None if area is None else int(count) * area,
+            "window": [int(row), int(col), int(height), int(width)],
+            "bounds": list(windows.bounds(Window(int(col), int(row), int(width), int(height)), transform)),
         }
-    print(json.dumps(result))
-    sys.stdout.flush()
-
-def parallel_processes():
-    base_path = Path(__file__).resolve().parent
-    paths = {
-        "red_band_old": base_path / "NDVI B4 B5" / start_folder / "band4.TIF",
-        "nir_band_old": base_path / "NDVI B4 B5" / start_folder / "band5.TIF",
-        "red_band_new": base_path / "NDVI B4 B5" / end_folder / "band4.TIF",
-        "nir_band_new": base_path / "NDVI B4 B5" / end_folder / "band5.TIF",
-        "ndvi_old": base_path / "temp_results/ndvis/ndvi-old.tif",
-        "ndvi_new": base_path / "temp_results/ndvis/ndvi-new.tif",
-        "ndvi_change": base_path / "temp_results/ndvis/ndvi_change.tif",
-        "savi_old": base_path / "temp_results/savis/savi-old.tif",
-        "savi_new": base_path / "temp_results/savis/savi-new.tif",
-        "savi_change": base_path / "temp_results/savis/savi_change.tif",
+
+    top_cells = np.argsort(cells, axis=None)[::-1][:top_k]
+    top_patches = np.argsort(pixels)[::-1][:top_k]
+    return {
+        "crs": crs.to_string() if crs else None,
+        "transform": list(transform)[:6],
+        "cell_pixels": cell,
+        "cells": cells.tolist(),
+        "top_cells": [region(row, col, min(cell, hotspots["height"] - row), min(cell, hotspots["width"] - col), cells.flat[i])
+                      for i, row, col in ((i, i // cells.shape[1] * cell, i % cells.shape[1] * cell) for i in top_cells) if cells.flat[i]],
+        "patch_count": len(roots),
+        "patches": [region(top[i], left[i], bottom[i] - top[i], right[i] - left[i], pixels[i]) for i in top_patches],
     }
 
+def detect_change(old_scene, new_scene, outputs=None, thresholds=CHANGE_THRESHOLDS, tile_memory_mb=TILE_MEMORY_MB, timings=None, hotspots_path=None):
+    """Computes the index changes and the deforested pixel count of two scene folders in one pass.
+
+    outputs optionally maps <index>_change names to a path; only those rasters are written.
+    The scenes are compared over their overlap, see open_change. With hotspots_path,
+    the deforestation mask is also summarized into a cell grid and connected patches (see
+    hotspot_summary), written there as JSON, and the top patches are returned as "hotspots".
+    """
+    outputs = outputs or {}
+    with open_change(old_scene, new_scene, thresholds, timings) as change, \
+         ExitStack() as stack:
+        grid = change["grid"]
+        deforested_pixels = 0
+        hotspots = new_hotspots(grid.height, grid.width) if hotspots_path else None
+        dsts = {name: stack.enter_context(open_output(path, change["meta"], change["scale"])) for name, path in outputs.items()}
+        for window in tile_windows(change["src"], tile_memory_mb, CHANGE_BYTES_PER_PIXEL, grid.height, grid.width):
+            tiles = change["tiles"](window)
+            deforested_pixels += int(np.count_nonzero(tiles["deforested"]))
+            if hotspots is not None:
+                start = time.perf_counter()
+                add_hotspot_tile(hotspots, window, tiles["deforested"])
+                add_timing(timings, "hotspots", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for name, dst in dsts.items():
+                dst.write(tiles[name], 1, window=window)
+            add_timing(timings, "write", time.perf_counter() - start)
+        closing = time.perf_counter()
+    add_timing(timings, "write", time.perf_counter() - closing, bytes_written=file_sizes(*outputs.values()))
+    record_peaks(timings, "read", "change", "write")
+
+    result = {"deforested_pixels": deforested_pixels, "total_pixels": grid.height * grid.width}
+    if hotspots is not None:
+        start = time.perf_counter()
+        summary = hotspot_summary(hotspots, change["transform"], change["crs"])
+        with open(hotspots_path, 'w') as f:
+            json.dump(summary, f)
+        add_timing(timings, "hotspots", time.perf_counter() - start, bytes_written=file_sizes(hotspots_path))
+        record_peaks(timings, "hotspots")
+        result["hotspots"] = summary["patches"]
+    return result
+
+def scene_band_paths(folder):
+    """Returns {band: path} of the bands the indices use, from a scene folder, archive or remote scene; see sources.scene_bands."""
+    return sources.scene_bands(folder, KERNEL["bands"])
+
+def scene_key(folder, L=L):
+    """Returns the scene cache key of a folder's current bands, L and SCENE_OUTPUT_SETTINGS."""
+    band_paths = scene_band_paths(folder)
+    return result_cache.cache_key(list(band_paths.values()), {"L": L, **SCENE_OUTPUT_SETTINGS})
+
+@contextmanager
+def scene_products(folder, L=L, timings=None):
+    """Yields the cache folder holding the index rasters (<index>.tif) and previews (<index>.png) of a scene.
+
+    Products are computed once per band contents, index expressions and L, then reused by every
+    pair that includes the scene. Changed bands produce a new key, and the stale entry ages out of
+    the LRU. The entry is leased until the block exits, so it can't be evicted while in use.
+    """
+    band_paths = scene_band_paths(folder)
+    key = scene_key(folder, L)
+    with result_cache.lease(key, result_cache.SCENE_CACHE_PATH):
+        cached = result_cache.load_result(key, result_cache.SCENE_CACHE_PATH) is not None
+        count_cache(timings, "scene", cached)
+        if not cached:
+            build = lambda out: compute_indices(band_paths, out, L, timings=timings)
+            result_cache.store_result(key, build, result_cache.SCENE_CACHE_PATH)
+        yield result_cache.SCENE_CACHE_PATH / key
+
+@contextmanager
+def analysed_scene(folder, L=L):
+    """Yields the leased cache folder of a scene's products, raising FileNotFoundError if they aren't cached.
+
+    For request threads, which read the products of scenes analysed by a job but never compute them.
+    """
+    key = scene_key(folder, L)
+    with result_cache.lease(key, result_cache.SCENE_CACHE_PATH):
+        if result_cache.load_result(key, result_cache.SCENE_CACHE_PATH) is None:
+            raise FileNotFoundError(f"Scene {folder} has not been analysed yet")
+        yield result_cache.SCENE_CACHE_PATH / key
+
+def link_or_copy(src, dst):
+    """Hard-links a cached file into an output folder, copying across filesystems."""
+    # Never write through an existing link into the cache
+    Path(dst).unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def analysis_paths(start_folder, end_folder, output_folder=BASE_PATH / "temp_results"):
+    """Returns the input bands (<band>_band_old/new) and the per-index outputs (<index>_old/new/change) of a pair."""
+    output_folder = Path(output_folder)
+    paths = {}
+    for age, folder in (("old", start_folder), ("new", end_folder)):
+        paths.update({f"{band}_band_{age}": path for band, path in scene_band_paths(folder).items()})
+    for name in INDEX_EXPRESSIONS:
+        paths.update({
+            f"{name}_old": output_folder / f"{name}s/{name}-old.tif",
+            f"{name}_new": output_folder / f"{name}s/{name}-new.tif",
+            f"{name}_change": output_folder / f"{name}s/{name}_change.tif",
+        })
+    return paths
+
+def parallel_processes(start_folder, end_folder, output_folder=BASE_PATH / "temp_results", L=L, deforestation_alert_threshold=DEFORESTATION_ALERT_THRESHOLD, timings=None, **index_thresholds):
+    """Runs the analysis for a start/end folder pair and returns the deforestation result.
+
+    The keyword parameters mirror ANALYSIS_PARAMS, <index>_threshold included, so
+    parallel_processes(start, end, **params) works. A new_timings() record passed as timings
+    is filled with the duration and I/O of each stage.
+    """
+    unknown = set(index_thresholds) - set(ANALYSIS_PARAMS)
+    if unknown:
+        raise TypeError(f"Unexpected parameters: {', '.join(sorted(unknown))}")
+    thresholds = change_thresholds({**ANALYSIS_PARAMS, **index_thresholds})
+    paths = analysis_paths(start_folder, end_folder, output_folder)
+
     # Ensure directories exist
-    Path(paths["ndvi_old"]).parent.mkdir(parents=True, exist_ok=True)
-    Path(paths["savi_old"]).parent.mkdir(parents=True, exist_ok=True)
+    for name in INDEX_EXPRESSIONS:
+        Path(paths[f"{name}_old"]).parent.mkdir(parents=True, exist_ok=True)
+
+    with ExitStack() as scenes:
+        # Each scene thread records into its own timings, merged once both are done
+        scene_timings = [new_timings(), new_timings()]
+        open_scene = lambda folder, record: scenes.enter_context(scene_products(folder, L, record))
+        with ThreadPoolExecutor() as executor:
+            old_scene, new_scene = executor.map(open_scene, [start_folder, end_folder], scene_timings)
+        if timings is not None:
+            for record in scene_timings:
+                merge_timings(timings, record)
+
+        # Previews, and the per-scene rasters when asked for, come straight from the scene cache
+        outputs = {}
+        start = time.perf_counter()
+        scene_files = {f"{name}_{age}": scene / name for name in INDEX_EXPRESSIONS for age, scene in (("old", old_scene), ("new", new_scene))}
+        for name, scene_file in scene_files.items():
+            link_or_copy(scene_file.with_suffix(".png"), paths[name].with_suffix(".png"))
+            if WRITE_INTERMEDIATE_RASTERS:
+                link_or_copy(scene_file.with_suffix(".tif"), paths[name])
+        add_timing(timings, "link", time.perf_counter() - start)
+        record_peaks(timings, "link")
+
+        # Intermediate rasters only go to disk when explicitly asked for
+        if WRITE_INTERMEDIATE_RASTERS:
+            outputs = {f"{name}_change": paths[f"{name}_change"] for name in thresholds}
 
-    with ThreadPoolExecutor() as executor:
-        executor.submit(compute_indices, paths["red_band_old"], paths["nir_band_old"], paths["ndvi_old"], paths["savi_old"], paths["ndvi_old"].with_suffix(".png"), paths["savi_old"].with_suffix(".png"))
-        executor.submit(compute_indices, paths["red_band_new"], paths["nir_band_new"], paths["ndvi_new"], paths["savi_new"], paths["ndvi_new"].with_suffix(".png"), paths["savi_new"].with_suffix(".png"))
+        change = detect_change(old_scene, new_scene, outputs, thresholds, timings=timings, hotspots_path=Path(output_folder) / HOTSPOTS_FILE)
 
-    compare_indices(paths["ndvi_old"], paths["ndvi_new"], paths["ndvi_change"])
-    compare_indices(paths["savi_old"], paths["savi_new"], paths["savi_change"])
-    detect_deforestation(paths["ndvi_change"], paths["savi_change"])
+        result = deforestation_result(change["deforested_pixels"], change["total_pixels"], deforestation_alert_threshold)
+        result.update(deforested_pixels=change["deforested_pixels"], total_pixels=change["total_pixels"], hotspots=change["hotspots"])
+        return result
 
 if __name__ == "__main__":
-    parallel_processes()
\ No newline at end of file
+    print(json.dumps(parallel_processes(sys.argv[1], sys.argv[2])))
+    sys.stdout.flush()
\ No newline at end of file
@@ -1,199 +1,52 @@
 import rasterio
 import numpy as np
 import json
+import math
 import sys
 from pathlib import Path  
 import cv2
+from rasterio import windows
+from rasterio.windows import Window
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
+from contextlib import ExitStack
 import time
 
+import ndvi_calc
+from ndvi_calc import aligned_source, open_output, overlap_window, read_aligned, tile_buffers
+
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Get Folder Paths from Command Line
-start_folder = Path(sys.argv[1])
-end_folder = Path(sys.argv[2])
-
 # Load Configuration
-with open('config.json', 'r') as f:
+with open(Path(__file__).resolve().parent / 'config.json', 'r') as f:
     config = json.load(f)
 
-L = config["L"]
-NDVI_THRESHOLD = config["ndvi_threshold"]
-SAVI_THRESHOLD = config["savi_threshold"]
-DEFORESTATION_ALERT_THRESHOLD = config["deforestation_alert_threshold"]
-CLOUD_SHADOW_THRESHOLD = config["cloud_shadow_threshold"]
-BRIGHTNESS_THRESHOLD = config["brightness_threshold"]
-
-def apply_cloud_shadow_mask(red, nir):
-    """Applies cloud and shadow mask based on brightness threshold."""
-    brightness = (red + nir) / 2
-    mask = brightness > CLOUD_SHADOW_THRESHOLD
-    red[mask] = np.nan
-    nir[mask] = np.nan
-    return red, nir
+# Used when config.json no longer has a change_threshold for ndvi or savi, which this script hardwires
+DEFAULT_CHANGE_THRESHOLD = -0.2
 
-def dark_object_subtraction(band):
-    """Applies Dark Object Subtraction (DOS) for atmospheric correction."""
-    dark_object_value = np.nanpercentile(band, 1)
-    corrected = band - dark_object_value
-    corrected[corrected < 0] = 0
-    return corrected
-
-def save_as_png(data, output_png_path):
-    """Normalizes and saves the data as a PNG image."""
-    min_val, max_val = np.nanmin(data), np.nanmax(data)
-    normalized = ((data - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-    cv2.imwrite(str(output_png_path), normalized)
-    logging.info(f"Saved PNG: {output_png_path}")
-
-def compute_indices(red_band_path, nir_band_path, output_ndvi_path, output_savi_path, ndvi_png_path, savi_png_path, L=L):
-    """Computes NDVI and SAVI indices from the red and NIR bands."""
-    try:
-        with rasterio.open(red_band_path, mmap=True, num_threads="all_cpus") as red_src, \
-             rasterio.open(nir_band_path, mmap=True, num_threads="all_cpus") as nir_src:
-
-            red = red_src.read(1).astype(np.float32)
-            nir = nir_src.read(1).astype(np.float32)
-
-            # Apply Atmospheric Correction
-            red = dark_object_subtraction(red)
-            nir = dark_object_subtraction(nir)
-
-            # Apply Cloud and Shadow Masking
-            red, nir = apply_cloud_shadow_mask(red, nir)
-
-            np.seterr(divide='ignore', invalid='ignore')
-            ndvi = (nir - red) / (nir + red)
-            savi = ((nir - red) / (nir + red + L)) * (1 + L)
-
-            meta = red_src.meta
-            meta.update(dtype=rasterio.float32, count=1)
-
-            with rasterio.open(output_ndvi_path, 'w', **meta, num_threads="all_cpus") as ndvi_dst:
-                ndvi_dst.write(ndvi, 1)
-            with rasterio.open(output_savi_path, 'w', **meta, num_threads="all_cpus") as savi_dst:
-                savi_dst.write(savi, 1)
-            
-            save_as_png(ndvi, ndvi_png_path)
-            save_as_png(savi, savi_png_path)
-
-        logging.info(f"Computed indices for: {red_band_path} and {nir_band_path}")
-    except Exception as e:
-        logging.error(f"Error in computing indices: {e}")
-
-def compare_indices(old_path, new_path, output_change_path):
-    """Compares two indices and calculates change."""
-    try:
-        with rasterio.open(old_path, mmap=True, num_threads="all_cpus") as old_src, \
-             rasterio.open(new_path, mmap=True, num_threads="all_cpus") as new_src:
-             
-            old_data, new_data = old_src.read(1).astype(np.float32), new_src.read(1).astype(np.float32)
-            min_rows, min_cols = min(old_data.shape[0], new_data.shape[0]), min(old_data.shape[1], new_data.shape[1])
-            change = new_data[:min_rows, :min_cols] - old_data[:min_rows, :min_cols]
-
-            meta = old_src.meta
-            meta.update(dtype=rasterio.float32, count=1, height=min_rows, width=min_cols)
-            with rasterio.open(output_change_path, 'w', **meta, num_threads="all_cpus") as dst:
-                dst.write(change, 1)
-
-        logging.info(f"Compared indices: {old_path} vs {new_path}")
-    except Exception as e:
-        logging.error(f"Error in comparing indices: {e}")
-
-def detect_deforestation(ndvi_change_path, savi_change_path):
-    """Detects deforestation using NDVI and SAVI change thresholds."""
-    try:
-        with rasterio.open(ndvi_change_path, mmap=True, num_threads="all_cpus") as ndvi_src, \
-             rasterio.open(savi_change_path, mmap=True, num_threads="all_cpus") as savi_src:
-
-            ndvi_change, savi_change = ndvi_src.read(1), savi_src.read(1)
-            deforested_pixels = np.sum((ndvi_change < NDVI_THRESHOLD) & (savi_change < SAVI_THRESHOLD))
-            deforestation_percentage = round((deforested_pixels / ndvi_change.size) * 100, 2)
-            result = {
-                "deforestation_percentage": deforestation_percentage,
-                "status": "🚨 Significant deforestation detected!" if deforestation_percentage > DEFORESTATION_ALERT_THRESHOLD else "✅ No significant deforestation detected."
-            }
-        
-        logging.info(json.dumps(result))
-    except Exception as e:
-        logging.error(f"Error in detecting deforestation: {e}")
-
-def parallel_processes():
-    """Manages parallel computation of indices and comparisons."""
-    base_path = Path(__file__).resolve().parent
-    input_folder = config["input_folder"]
-    output_folder = config["output_folder"]
-    
-    # Define paths and ensure output directories exist
-    paths = {
-        "red_band_old": base_path / input_folder / start_folder / "band4.TIF",
-        "nir_band_old": base_path / input_folder / start_folder / "band5.TIF",
-        "ndvi_old": base_path / output_folder / start_folder / "ndvi.TIF",
-        "savi_old": base_path / output_folder / start_folder / "savi.TIF",
-        "red_band_new": base_path / input_folder / end_folder / "band4.TIF",
-        "nir_band_new": base_path / input_folder / end_folder / "band5.TIF",
-        "ndvi_new": base_path / output_folder / end_folder / "ndvi.TIF",
-        "savi_new": base_path / output_folder / end_folder / "savi.TIF"
-    }
-
-    # Ensure output directories exist
-    paths["ndvi_old"].parent.mkdir(parents=True, exist_ok=True)
-    paths["ndvi_new"].parent.mkdir(parents=True, exist_ok=True)
-
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(
-                compute_indices, 
-                paths["red_band_old"], 
-                paths["nir_band_old"], 
-                paths["ndvi_old"], 
-                paths["savi_old"], 
-                paths["ndvi_old"].with_suffix(".png"), 
-                paths["savi_old"].with_suffix(".png")
-            ),
-            executor.submit(
-                compute_indices, 
-                paths["red_band_new"], 
-                paths["nir_band_new"], 
-                paths["ndvi_new"], 
-                paths["savi_new"], 
-                paths["ndvi_new"].with_suffix(".png"), 
-                paths["savi_new"].with_suffix(".png")
-            )
-        ]
-
-        for future in as_completed(futures):
-            future.result()
-            
-import rasterio
-import numpy as np
-import json
-import sys
-from pathlib import Path  
-import cv2
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import logging
-import time
-
-# Setup Logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Get Folder Paths from Command Line
-start_folder = Path(sys.argv[1])
-end_folder = Path(sys.argv[2])
-
-# Load Configuration
-with open('config.json', 'r') as f:
-    config = json.load(f)
+def change_threshold(name):
+    """Returns the configured change threshold of an index, or DEFAULT_CHANGE_THRESHOLD with a warning."""
+    threshold = config["indices"].get(name, {}).get("change_threshold")
+    if threshold is None:
+        logging.warning(f"No change_threshold for index {name} in config.json, using {DEFAULT_CHANGE_THRESHOLD}")
+        return DEFAULT_CHANGE_THRESHOLD
+    return threshold
 
 L = config["L"]
-NDVI_THRESHOLD = config["ndvi_threshold"]
-SAVI_THRESHOLD = config["savi_threshold"]
+NDVI_THRESHOLD = change_threshold("ndvi")
+SAVI_THRESHOLD = change_threshold("savi")
 DEFORESTATION_ALERT_THRESHOLD = config["deforestation_alert_threshold"]
 CLOUD_SHADOW_THRESHOLD = config["cloud_shadow_threshold"]
 BRIGHTNESS_THRESHOLD = config["brightness_threshold"]
+TILE_MEMORY_MB = config["tile_memory_mb"]
+# Working set per pixel of a tile: the fused kernel's five float32 buffers and mask, plus write slack
+TILE_BYTES_PER_PIXEL = 32
+
+def update_range(value_range, data):
+    """Widens value_range in place with the NaN-ignoring min/max of data."""
+    value_range[0] = np.fmin(value_range[0], np.fmin.reduce(data, axis=None))
+    value_range[1] = np.fmax(value_range[1], np.fmax.reduce(data, axis=None))
 
 def apply_cloud_shadow_mask(red, nir):
     """Applies cloud and shadow mask based on brightness threshold."""
@@ -203,52 +56,137 @@ def apply_cloud_shadow_mask(red, nir):
     nir[mask] = np.nan
     return red, nir
 
-def dark_object_subtraction(band):
-    """Applies Dark Object Subtraction (DOS) for atmospheric correction."""
-    dark_object_value = np.nanpercentile(band, 1)
-    corrected = band - dark_object_value
-    corrected[corrected < 0] = 0
-    return corrected
-
-def save_as_png(data, output_png_path):
-    """Normalizes and saves the data as a PNG image."""
-    min_val, max_val = np.nanmin(data), np.nanmax(data)
-    normalized = ((data - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+def estimate_dark_object_value(src, tile_memory_mb=TILE_MEMORY_MB, bytes_per_pixel=TILE_BYTES_PER_PIXEL):
+    """Estimates the DOS dark object value from a decimated read that fits in tile_memory_mb."""
+    budget_pixels = int((tile_memory_mb or 0) * 1024 * 1024 // bytes_per_pixel) or src.width * src.height
+    step = max(int(np.ceil(np.sqrt(src.width * src.height / budget_pixels))), 1)
+    sample = src.read(1, out_shape=(max(src.height // step, 1), max(src.width // step, 1))).astype(np.float32)
+    return np.nanpercentile(sample, 1)
+
+def histogram_percentile(counts, q):
+    """Returns the q-th percentile of the values described by a histogram, matching np.percentile."""
+    cumulative = np.cumsum(counts)
+    if cumulative[-1] == 0:
+        return np.nan
+    position = (cumulative[-1] - 1) * q / 100
+    lower = int(np.floor(position))
+    # The k-th smallest value is the first bin whose cumulative count exceeds k
+    lower_value, upper_value = np.searchsorted(cumulative, [lower, lower + 1], side='right')
+    upper_value = min(upper_value, len(counts) - 1)
+    return lower_value + (position - lower) * (upper_value - lower_value)
+
+def dark_object_value(src, tile_memory_mb=TILE_MEMORY_MB):
+    """Returns the DOS dark object value (1st percentile) of a band.
+
+    Integer bands of up to 16 bits are streamed tile by tile into a histogram of their DN
+    values, which gives the exact percentile without sorting the scene. Other types fall back
+    to estimate_dark_object_value.
+    """
+    dtype = np.dtype(src.dtypes[0])
+    if not np.issubdtype(dtype, np.integer) or dtype.itemsize > 2:
+        return estimate_dark_object_value(src, tile_memory_mb)
+
+    offset = -np.iinfo(dtype).min
+    counts = np.zeros(2 ** (8 * dtype.itemsize), dtype=np.int64)
+    for window in ndvi_calc.tile_windows(src, tile_memory_mb, TILE_BYTES_PER_PIXEL):
+        data = src.read(1, window=window).ravel()
+        counts += np.bincount(data.astype(np.int32) + offset if offset else data, minlength=len(counts))
+    return histogram_percentile(counts, 1) - offset
+
+def dark_object_subtraction(band, dark_object_value=None):
+    """Applies Dark Object Subtraction (DOS) for atmospheric correction, in place."""
+    if dark_object_value is None:
+        dark_object_value = np.nanpercentile(band, 1)
+    band -= band.dtype.type(dark_object_value)
+    # np.maximum keeps NaN, like the masked assignment it replaces
+    np.maximum(band, 0, out=band)
+    return band
+
+def kernel_buffers(pixels):
+    """Preallocates the flat buffers fused_indices works in, for tiles of up to pixels pixels."""
+    buffers = ndvi_calc.kernel_buffers({"buffers": ("red", "nir", "sum", "ndvi", "savi")}, pixels)
+    buffers["mask"] = np.empty(pixels, dtype=bool)
+    return buffers
+
+def fused_indices(red, nir, red_dark_value, nir_dark_value, out, L=L):
+    """Applies DOS and the cloud/shadow mask and computes NDVI and SAVI into out["ndvi"] and out["savi"].
+
+    Equivalent to dark_object_subtraction, apply_cloud_shadow_mask and the index formulas, but
+    the band sum and difference are computed once into the buffers of out (red and nir are
+    overwritten) and no full-tile temporaries are allocated. With numexpr on a multi-core
+    machine, each index is evaluated in a single blocked, threaded pass instead.
+    """
+    dark_object_subtraction(red, red_dark_value)
+    dark_object_subtraction(nir, nir_dark_value)
+    # (red + nir) / 2 > threshold, without materializing the brightness
+    brightness_limit = np.float32(CLOUD_SHADOW_THRESHOLD) * 2
+    ndvi, savi = out["ndvi"], out["savi"]
+
+    if ndvi_calc.USE_NUMEXPR:
+        local_dict = {"red": red, "nir": nir, "limit": brightness_limit, "L": np.float32(L), "nan": np.float32(np.nan)}
+        ndvi_calc.numexpr.evaluate("where(red + nir > limit, nan, (nir - red) / (nir + red))", local_dict=local_dict, out=ndvi)
+        ndvi_calc.numexpr.evaluate("where(red + nir > limit, nan, (nir - red) / (nir + red + L) * (1 + L))", local_dict=local_dict, out=savi)
+        return ndvi, savi
+
+    total, mask = np.add(nir, red, out=out["sum"]), out["mask"]
+    np.greater(total, brightness_limit, out=mask)
+    difference = np.subtract(nir, red, out=nir)
+    np.divide(difference, total, out=ndvi)
+    total += np.float32(L)
+    np.divide(difference, total, out=savi)
+    savi *= np.float32(1 + L)
+    np.copyto(ndvi, np.nan, where=mask)
+    np.copyto(savi, np.nan, where=mask)
+    return ndvi, savi
+
+def save_as_png(raster_path, output_png_path, min_val, max_val, tile_memory_mb=TILE_MEMORY_MB):
+    """Normalizes the raster tile by tile into an 8-bit image and saves it as a PNG."""
+    with rasterio.open(raster_path, num_threads="all_cpus") as src:
+        normalized = np.empty((src.height, src.width), dtype=np.uint8)
+        for window in ndvi_calc.tile_windows(src, tile_memory_mb, TILE_BYTES_PER_PIXEL):
+            data = src.read(1, window=window)
+            normalized[window.toslices()] = ((data - min_val) / (max_val - min_val) * 255).astype(np.uint8)
     cv2.imwrite(str(output_png_path), normalized)
     logging.info(f"Saved PNG: {output_png_path}")
 
-def compute_indices(red_band_path, nir_band_path, output_ndvi_path, output_savi_path, ndvi_png_path, savi_png_path, L=L):
-    """Computes NDVI and SAVI indices from the red and NIR bands."""
+def compute_indices(red_band_path, nir_band_path, output_ndvi_path, output_savi_path, ndvi_png_path, savi_png_path, L=L, tile_memory_mb=TILE_MEMORY_MB):
+    """Computes NDVI and SAVI indices from the red and NIR bands, one tile at a time."""
     try:
         with rasterio.open(red_band_path, mmap=True, num_threads="all_cpus") as red_src, \
              rasterio.open(nir_band_path, mmap=True, num_threads="all_cpus") as nir_src:
 
-            red = red_src.read(1).astype(np.float32)
-            nir = nir_src.read(1).astype(np.float32)
-
-            # Apply Atmospheric Correction
-            red = dark_object_subtraction(red)
-            nir = dark_object_subtraction(nir)
-
-            # Apply Cloud and Shadow Masking
-            red, nir = apply_cloud_shadow_mask(red, nir)
-
-            np.seterr(divide='ignore', invalid='ignore')
-            ndvi = (nir - red) / (nir + red)
-            savi = ((nir - red) / (nir + red + L)) * (1 + L)
+            # Dark object values are scene-wide, so they are fixed before streaming the tiles
+            red_dark_value = dark_object_value(red_src, tile_memory_mb)
+            nir_dark_value = dark_object_value(nir_src, tile_memory_mb)
 
             meta = red_src.meta
             meta.update(dtype=rasterio.float32, count=1)
 
-            # Write NDVI and SAVI to disk
-            with rasterio.open(output_ndvi_path, 'w', **meta, num_threads="all_cpus") as ndvi_dst:
-                ndvi_dst.write(ndvi, 1)
-            with rasterio.open(output_savi_path, 'w', **meta, num_threads="all_cpus") as savi_dst:
-                savi_dst.write(savi, 1)
-            
+            np.seterr(divide='ignore', invalid='ignore')
+            ndvi_range, savi_range = [np.inf, -np.inf], [np.inf, -np.inf]
+
+            # Write NDVI and SAVI to disk tile by tile
+            with open_output(output_ndvi_path, meta) as ndvi_dst, \
+                 open_output(output_savi_path, meta) as savi_dst:
+                windows = list(ndvi_calc.tile_windows(red_src, tile_memory_mb, TILE_BYTES_PER_PIXEL))
+                buffers = kernel_buffers(max(window.height * window.width for window in windows))
+                for window in windows:
+                    # Bands are read straight into the reused float32 buffers
+                    out = tile_buffers(buffers, window.height, window.width)
+                    red = red_src.read(1, window=window, out=out["red"])
+                    nir = nir_src.read(1, window=window, out=out["nir"])
+
+                    # Atmospheric correction, cloud/shadow masking and both indices in one pass
+                    ndvi, savi = fused_indices(red, nir, red_dark_value, nir_dark_value, out, L)
+
+                    ndvi_dst.write(ndvi, 1, window=window)
+                    savi_dst.write(savi, 1, window=window)
+                    update_range(ndvi_range, ndvi)
+                    update_range(savi_range, savi)
+
             # Save PNGs for visualization
-            save_as_png(ndvi, ndvi_png_path)
-            save_as_png(savi, savi_png_path)
+            save_as_png(output_ndvi_path, ndvi_png_path, *ndvi_range, tile_memory_mb=tile_memory_mb)
+            save_as_png(output_savi_path, savi_png_path, *savi_range, tile_memory_mb=tile_memory_mb)
 
         logging.info(f"Computed indices for: {red_band_path} and {nir_band_path}")
     except Exception as e:
@@ -258,15 +196,19 @@ def compare_indices(old_path, new_path, output_change_path):
     """Compares two indices and calculates change."""
     try:
         with rasterio.open(old_path, mmap=True, num_threads="all_cpus") as old_src, \
-             rasterio.open(new_path, mmap=True, num_threads="all_cpus") as new_src:
-             
-            old_data, new_data = old_src.read(1).astype(np.float32), new_src.read(1).astype(np.float32)
-            min_rows, min_cols = min(old_data.shape[0], new_data.shape[0]), min(old_data.shape[1], new_data.shape[1])
-            change = new_data[:min_rows, :min_cols] - old_data[:min_rows, :min_cols]
+             rasterio.open(new_path, mmap=True, num_threads="all_cpus") as new_src, \
+             ExitStack() as stack:
+
+            # Only the geographic overlap is read, on the old raster's grid
+            grid = overlap_window(old_src, [new_src])
+            full = Window(0, 0, grid.width, grid.height)
+            old_data = read_aligned(aligned_source(old_src, old_src, grid, stack), full).astype(np.float32)
+            new_data = read_aligned(aligned_source(new_src, old_src, grid, stack), full).astype(np.float32)
+            change = new_data - old_data
 
             meta = old_src.meta
-            meta.update(dtype=rasterio.float32, count=1, height=min_rows, width=min_cols)
-            with rasterio.open(output_change_path, 'w', **meta, num_threads="all_cpus") as dst:
+            meta.update(dtype=rasterio.float32, count=1, height=grid.height, width=grid.width, transform=windows.transform(grid, old_src.transform))
+            with open_output(output_change_path, meta, windowed=False) as dst:
                 dst.write(change, 1)
 
         logging.info(f"Compared indices: {old_path} vs {new_path}")
@@ -291,7 +233,7 @@ def detect_deforestation(ndvi_change_path, savi_change_path):
     except Exception as e:
         logging.error(f"Error in detecting deforestation: {e}")
 
-def parallel_processes():
+def parallel_processes(start_folder, end_folder):
     """Manages parallel computation of indices and comparisons."""
     base_path = Path(__file__).resolve().parent
     input_folder = config["input_folder"]
@@ -351,6 +293,10 @@ def parallel_processes():
             
 
 if __name__ == "__main__":
+    # Get Folder Paths from Command Line
+    start_folder = Path(sys.argv[1])
+    end_folder = Path(sys.argv[2])
+
     start_time = time.time()
-    parallel_processes()
+    parallel_processes(start_folder, end_folder)
     logging.info(f"Processing completed in {time.time() - start_time:.2f} seconds.")
@@ -0,0 +1,228 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import sources
+
+BASE_PATH = Path(__file__).resolve().parent
+
+with open(BASE_PATH / 'config.json', 'r') as f:
+    config = json.load(f)
+
+CACHE_PATH = BASE_PATH / config["result_cache_folder"]
+CACHE_MAX_BYTES = config["result_cache_mb"] * 1024 * 1024
+# Per-scene index products, shared by every pair that includes the scene
+SCENE_CACHE_PATH = BASE_PATH / config["scene_cache_folder"]
+SCENE_CACHE_MAX_BYTES = config["scene_cache_mb"] * 1024 * 1024
+# Entries unused for longer than this are deleted by sweep(), even under the size limit
+CACHE_TTL_SECONDS = config["result_cache_ttl_seconds"]
+SCENE_CACHE_TTL_SECONDS = config["scene_cache_ttl_seconds"]
+CACHE_SWEEP_SECONDS = config["cache_sweep_seconds"]
+RESULT_FILE = "result.json"
+# Relative path -> sha256 of every file of an entry but the result, for content-addressed URLs
+MANIFEST_FILE = "manifest.json"
+# One lock file per key, share-locked by lease() and exclusively locked by evict() to delete the entry
+LEASES_FOLDER = ".leases"
+# Flocked by evict(), so sweeps of several processes (server workers, batch runs) take turns
+EVICT_LOCK_FILE = ".evict.lock"
+
+# Guards eviction so concurrent sweeps don't delete the same entries twice
+_lock = threading.Lock()
+
+def cache_key(band_paths, params):
+    """Hashes the input band identities and analysis parameters into a cache key."""
+    payload = json.dumps({"bands": [sources.band_identity(path) for path in band_paths], "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def load_result(key, cache_path=CACHE_PATH):
+    """Returns the cached result for key, or None on a miss. Hits refresh the entry's LRU position."""
+    result_path = cache_path / key / RESULT_FILE
+    try:
+        with open(result_path, 'r') as f:
+            result = json.load(f)
+        os.utime(result_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return result
+
+@contextmanager
+def lease(key, cache_path=CACHE_PATH):
+    """Holds a shared lock on key, so evict() leaves its entry alone until the block exits.
+
+    Entries read after load_result, or whose files are opened later, are leased first. A key
+    can be leased before its entry is stored, which keeps the entry from the moment it appears.
+    The lock is a file lock, so leases hold against sweeps in other processes too.
+    """
+    path = cache_path / LEASES_FOLDER / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # evict() deletes the lock file along with the entry; if that happened while waiting, lock the new one
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+def delete_entry(cache_path, key):
+    """Deletes the entry for key unless it is leased, and returns whether it was deleted."""
+    path = cache_path / LEASES_FOLDER / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        shutil.rmtree(cache_path / key, ignore_errors=True)
+        os.unlink(path)
+        return True
+    finally:
+        os.close(fd)
+
+def store_result(key, build, cache_path=CACHE_PATH):
+    """Runs build(folder) into a staging folder and publishes it as the cache entry for key.
+
+    build writes its outputs (e.g. the preview PNGs) into folder and returns the JSON result.
+    The cache size isn't enforced here but by sweep(), so no caller waits on a deletion; lease
+    the key first to keep the entry until it has been read.
+    """
+    staging = cache_path / f".{key}-{uuid.uuid4().hex}"
+    staging.mkdir(parents=True)
+    try:
+        result = build(staging)
+        with open(staging / RESULT_FILE, 'w') as f:
+            json.dump(result, f)
+        try:
+            os.rename(staging, cache_path / key)
+        except OSError:
+            # An identical request published first, keep its entry
+            shutil.rmtree(staging, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return result
+
+def file_digest(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_digests(folder):
+    return {file.relative_to(folder).as_posix(): file_digest(file) for file in sorted(folder.rglob("*")) if file.is_file()}
+
+def load_manifest(key, cache_path=CACHE_PATH):
+    """Returns the file digests of a cache entry, or None on a miss or while its manifest isn't built yet.
+
+    Never hashes, so it is safe on request threads; see build_manifest.
+    """
+    try:
+        with open(cache_path / key / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def build_manifest(key, cache_path=CACHE_PATH):
+    """Returns the file digests of a cache entry, hashing and writing them if missing, or None on a miss.
+
+    Called by the job that produced the entry and by the sweep; entries never change once published.
+    """
+    manifest = load_manifest(key, cache_path)
+    entry = cache_path / key
+    if manifest is not None or not (entry / RESULT_FILE).exists():
+        return manifest
+    manifest = {path: digest for path, digest in file_digests(entry).items() if path not in (RESULT_FILE, MANIFEST_FILE)}
+    staging = entry / f".{MANIFEST_FILE}-{uuid.uuid4().hex}"
+    with open(staging, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(staging, entry / MANIFEST_FILE)
+    return manifest
+
+def build_missing_manifests(cache_path=CACHE_PATH):
+    """Builds the manifests of published entries that have none, e.g. entries cached before manifests existed."""
+    if not cache_path.exists():
+        return
+    for path in cache_path.iterdir():
+        if path.is_dir() and not path.name.startswith(".") and not (path / MANIFEST_FILE).exists():
+            with lease(path.name, cache_path):
+                build_manifest(path.name, cache_path)
+
+def entry_size(path):
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+def evict(cache_path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, ttl_seconds=None):
+    """Deletes least recently used entries until the cache fits in max_bytes, skipping leased ones.
+
+    With ttl_seconds, entries and abandoned staging folders unused for longer are deleted too.
+    """
+    if not cache_path.exists():
+        return
+    cutoff = None if ttl_seconds is None else time.time() - ttl_seconds
+    with _lock, open(cache_path / EVICT_LOCK_FILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        entries = []
+        for path in cache_path.iterdir():
+            if not path.is_dir() or path.name == LEASES_FOLDER:
+                continue
+            if path.name.startswith("."):
+                # A build that crashed before publishing its entry
+                if cutoff is not None and path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            result_path = path / RESULT_FILE
+            if not result_path.exists():
+                continue
+            entries.append((result_path.stat().st_mtime, path, entry_size(path)))
+
+        total = sum(size for _, _, size in entries)
+        for last_used, path, size in sorted(entries):
+            if total <= max_bytes and (cutoff is None or last_used >= cutoff):
+                break
+            if delete_entry(cache_path, path.name):
+                total -= size
+
+        # Lock files of keys without an entry, e.g. leased on a miss whose build failed
+        leases = cache_path / LEASES_FOLDER
+        for path in leases.iterdir() if leases.exists() else []:
+            if not (cache_path / path.name).exists():
+                delete_entry(cache_path, path.name)
+
+def sweep(interval=CACHE_SWEEP_SECONDS):
+    """Applies the size limits and TTLs of the result and scene caches every interval seconds, forever.
+
+    Meant for a daemon thread, so no request ever waits on a deletion. Between sweeps, new
+    entries may take a cache past its limit.
+    """
+    while True:
+        sweep_once()
+        time.sleep(interval)
+
+def sweep_once():
+    """Applies the size limits and TTLs of the result and scene caches once, and builds missing result manifests."""
+    try:
+        build_missing_manifests(CACHE_PATH)
+    except OSError:
+        # Retried on the next sweep; until then those entries' URLs are treated as misses
+        pass
+    for cache_path, max_bytes, ttl_seconds in ((CACHE_PATH, CACHE_MAX_BYTES, CACHE_TTL_SECONDS),
+                                               (SCENE_CACHE_PATH, SCENE_CACHE_MAX_BYTES, SCENE_CACHE_TTL_SECONDS)):
+        try:
+            evict(cache_path, max_bytes, ttl_seconds=ttl_seconds)
+        except OSError:
+            # An entry vanished mid-scan, the next sweep picks up where this one stopped
+            pass
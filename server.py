@@ -1,11 +1,19 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Flask, jsonify, send_from_directory, request, Response, stream_with_context, g
 from flask_cors import CORS
-import subprocess
-import json
 from pathlib import Path
-import os
-import shutil
+import json
+import re
 import atexit
+import threading
+import time
+import baseline
+import catalog
+import jobs
+import metrics
+import ndvi_calc
+import result_cache
+import tiles
+import zonal
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -17,28 +25,46 @@ STATIC_PATH = BASE_PATH / "static"
 # Ensure static folder exists
 STATIC_PATH.mkdir(exist_ok=True)
 
-# Store the selected folder globally
-selected_folder = None
-image_request_count = 0
-TOTAL_IMAGES = 4
+# Result URLs carry a prefix of the file's sha256, so their content never changes and clients may cache them for a year
+RESULTS_BASE_URL = ndvi_calc.config["results_base_url"]
+URL_DIGEST_LENGTH = 16
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+CACHE_KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Longest a request blocks on a job before answering with its id to poll instead
+MAX_WAIT_SECONDS = 60
+
+# Expired and over-quota cache entries are deleted in the background, never on a request
+threading.Thread(target=result_cache.sweep, name="cache-sweep", daemon=True).start()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    if "request_start" in g:
+        metrics.observe("ndvi_http_request_duration_seconds", time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or "unmatched", method=request.method, status=response.status_code)
+    return response
 
 @app.route('/set-folder', methods=['POST'])
 def set_folder():
-    global selected_folder, start_folder, end_folder
-
-    data = request.get_json()
-    selected_folder = data.get("folder")
+    """Validate a folder pair; nothing is stored, /run-analysis takes the same pair in its query."""
+    # {"folder": "start_end"}, or start_folder and end_folder (in the body or the query) for names with underscores
+    data = {**request.args, **(request.get_json(silent=True) or {})}
 
-    if not selected_folder:
+    if not data.get("folder") and not data.get("start_folder") and not data.get("end_folder"):
         return jsonify({"error": "No folder provided"}), 400
 
-    parts = selected_folder.split("_")
-
-    if len(parts) != 2:
-        return jsonify({"error": "Invalid folder format. Expected 'start_end' format."}), 400
+    try:
+        parts = parse_pair(data)
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     start_folder, end_folder = parts
-
     return jsonify({
         "message": "Folders selected successfully",
         "start_folder": start_folder,
@@ -46,103 +72,283 @@ def set_folder():
     })
 
 
+def parse_pair(data):
+    """Returns the (start_folder, end_folder) of a job request.
+
+    Raises ValueError if it is malformed or the scenes don't overlap, FileNotFoundError if a scene is unknown.
+    """
+    if data.get("folder"):
+        parts = data["folder"].split("_")
+        if len(parts) != 2:
+            raise ValueError("Invalid folder format. Expected 'start_end' format.")
+    else:
+        parts = [data.get("start_folder"), data.get("end_folder")]
+
+    for folder in parts:
+        if not folder or not isinstance(folder, str) or folder in (".", "..") or "/" in folder or "\\" in folder:
+            raise ValueError(f"Invalid folder: {folder}")
+    catalog.check_pair(*parts)
+    return tuple(parts)
+
+def parse_params(overrides):
+    """Returns the analysis parameters with the request's overrides applied."""
+    params = dict(ndvi_calc.ANALYSIS_PARAMS)
+    for name, value in (overrides or {}).items():
+        if name not in params or isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"Invalid parameter: {name}")
+        params[name] = value
+    return params
+
+def record_timings(timings):
+    """Adds the stage durations, I/O and cache lookups of an analysis or baseline update to the /metrics totals."""
+    for stage, entry in timings["stages"].items():
+        metrics.inc("ndvi_stage_duration_seconds_total", entry["seconds"], stage=stage)
+        metrics.inc("ndvi_stage_read_bytes_total", entry["bytes_read"], stage=stage)
+        metrics.inc("ndvi_stage_written_bytes_total", entry["bytes_written"], stage=stage)
+    for cache, counts in timings["cache"].items():
+        for outcome, count in counts.items():
+            metrics.inc("ndvi_cache_requests_total", count, cache=cache, outcome=outcome)
+
+def analyze(key, folders, params):
+    """Returns the cached result for key, running the analysis into the cache on a miss, with its timings."""
+    start = time.perf_counter()
+    timings = ndvi_calc.new_timings()
+    with result_cache.lease(key):
+        result = result_cache.load_result(key)
+        ndvi_calc.count_cache(timings, "result", result is not None)
+        if result is None:
+            build = lambda folder: ndvi_calc.parallel_processes(*folders, output_folder=folder, timings=timings, **params)
+            result = result_cache.store_result(key, build)
+        # Hashed here, on the job's thread, rather than when a request first asks for the URLs
+        result_cache.build_manifest(key)
+    timings.update(seconds=time.perf_counter() - start, process_peak_rss_mb=ndvi_calc.peak_rss_mb())
+    metrics.observe("ndvi_analysis_duration_seconds", timings["seconds"], result_cache="hit" if timings["cache"]["result"]["hit"] else "miss")
+    record_timings(timings)
+    return {"data": result, "timings": timings}
+
+def fold_baseline(name, folder, params, statistic, min_observations):
+    """Compares a scene with a baseline and folds it in, with its timings."""
+    start = time.perf_counter()
+    timings = ndvi_calc.new_timings()
+    result = baseline.update_baseline(name, folder, params, statistic, min_observations, timings=timings)
+    timings.update(seconds=time.perf_counter() - start, process_peak_rss_mb=ndvi_calc.peak_rss_mb())
+    metrics.observe("ndvi_baseline_duration_seconds", timings["seconds"])
+    record_timings(timings)
+    return {"data": result, "timings": timings, "baseline": name}
+
+def analysis_key(folders, params):
+    """Returns the key cached results and jobs of a folder pair are stored under."""
+    # Keyed by the input bands, analysis parameters and every setting that changes the result files
+    band_paths = [path for folder in folders for path in ndvi_calc.scene_band_paths(folder).values()]
+    return result_cache.cache_key(band_paths, dict(params, **ndvi_calc.ANALYSIS_OUTPUT_SETTINGS))
+
+def submit_analysis(folders, params):
+    """Queues the analysis of a folder pair, sharing the job of an identical in-flight request."""
+    key = analysis_key(folders, params)
+    return jobs.submit(key, analyze, key, folders, params)
+
+def submit_baseline_update(name, data):
+    """Validates and queues a baseline update, sharing the job of an identical in-flight request."""
+    if not data.get("folder"):
+        raise ValueError("No folder provided")
+    folder, params = data["folder"], parse_params(data.get("params"))
+    statistic, min_observations = data.get("statistic", baseline.BASELINE_STATISTIC), data.get("min_observations", baseline.BASELINE_MIN_OBSERVATIONS)
+    baseline.check_update(name, folder, params, statistic, min_observations)
+    key = analysis_key([folder], dict(params, baseline=name, statistic=statistic, min_observations=min_observations))
+    return jobs.submit(key, fold_baseline, name, folder, params, statistic, min_observations)
+
+def result_url(key, manifest, filename):
+    """Returns the content-addressed URL of a result file, on results_base_url (e.g. a CDN) when set."""
+    base_url = RESULTS_BASE_URL.rstrip("/") + "/" if RESULTS_BASE_URL else request.host_url
+    return base_url + f"results/{key}/{manifest[filename][:URL_DIGEST_LENGTH]}/{filename}"
+
+def image_urls(key, manifest):
+    return {f"{name}_{age}": result_url(key, manifest, f"{name}s/{name}-{age}.png")
+            for name in ndvi_calc.INDEX_EXPRESSIONS for age in ("new", "old")}
+
+def job_response(job):
+    response_data = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        timings = dict(job["result"]["timings"], queue_seconds=job["started_at"] - job["submitted_at"])
+        response_data.update(data=job["result"]["data"], timings=timings)
+        if "baseline" in job["result"]:
+            response_data["baseline_url"] = request.host_url + f"baselines/{job['result']['baseline']}"
+            return response_data
+        manifest = result_cache.load_manifest(job["key"])
+        if manifest is None:
+            # Evicted since the job finished; running the analysis again recomputes the files and their manifest
+            response_data["message"] = "Result files have expired, run the analysis again"
+            return response_data
+        response_data["images"] = image_urls(job["key"], manifest)
+        # Results cached before hotspots were summarized have no hotspot index
+        if ndvi_calc.HOTSPOTS_FILE in manifest:
+            response_data["hotspots_url"] = result_url(job["key"], manifest, ndvi_calc.HOTSPOTS_FILE)
+    elif job["status"] == "failed":
+        response_data["message"] = job["error"]
+    return response_data
+
+def submit_error_response(e):
+    if isinstance(e, jobs.QueueFullError):
+        return jsonify({"status": "error", "message": str(e)}), 503, {"Retry-After": "5"}
+    if isinstance(e, FileNotFoundError):
+        return jsonify({"status": "error", "message": str(e)}), 404
+    return jsonify({"status": "error", "message": str(e)}), 400
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue an analysis of a folder pair and return its job id without waiting for it."""
+    data = request.get_json(silent=True) or {}
+    try:
+        job = submit_analysis(parse_pair(data), parse_params(data.get("params")))
+    except (ValueError, FileNotFoundError, jobs.QueueFullError) as e:
+        return submit_error_response(e)
+    return jsonify(job_response(job)), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return the status of a job, including its results once done. ?wait=<seconds> long-polls."""
+    wait = request.args.get("wait", type=float)
+    job = jobs.wait(job_id, min(wait, MAX_WAIT_SECONDS)) if wait else jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job_response(job))
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job(job_id):
+    """Stream a job's status changes as server-sent events until it finishes."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+
+    def events(job):
+        while True:
+            yield f"data: {json.dumps(job_response(job))}\n\n"
+            if job["status"] in jobs.FINISHED:
+                return
+            job = jobs.wait(job_id, 15, status=job["status"])
+            if job is None:
+                return
+
+    return Response(stream_with_context(events(job)), mimetype="text/event-stream")
+
 @app.route('/run-analysis', methods=['GET'])
 def run_analysis():
-    """Run the NDVI/SAVI analysis script and return JSON results with image links."""
-    if not selected_folder:
+    """Run the NDVI/SAVI analysis of ?folder=start_end (or ?start_folder=...&end_folder=...) and wait for its JSON results with image links.
+
+    Analyses still running after MAX_WAIT_SECONDS answer 202 with their job id, to poll at /jobs/<id>.
+    """
+    if not request.args.get("folder") and not request.args.get("start_folder") and not request.args.get("end_folder"):
         return jsonify({"status": "error", "message": "No folder selected"}), 400
-    
+
     try:
-        ndvi_script = str(BASE_PATH / "ndvi_calc.py")
-        result = subprocess.run(
-            ['python', ndvi_script, start_folder, end_folder], 
-            capture_output=True, text=True
-        )
-
-        print("STDOUT:", result.stdout)
-        print("STDERR:", result.stderr)
-
-        if result.stderr:
-            return jsonify({"status": "error", "message": result.stderr}), 500
-        
-        output_text = result.stdout.strip()
-        if not output_text:
-            return jsonify({"status": "error", "message": "No output received from script"}), 500
-
-        try:
-            output_json = json.loads(output_text)
-        except json.JSONDecodeError:
-            return jsonify({"status": "error", "message": "Invalid JSON output from script"}), 500
-        
-        image_urls = {
-            "ndvi_new": request.host_url + "temp_results/ndvis/ndvi-new.png",
-            "ndvi_old": request.host_url + "temp_results/ndvis/ndvi-old.png",
-            "savi_new": request.host_url + "temp_results/savis/savi-new.png",
-            "savi_old": request.host_url + "temp_results/savis/savi-old.png"
-        }
-
-
-        response_data = {
-            "status": "success",
-            "data": output_json,
-            "images": image_urls
-        }
-
-        return jsonify(response_data)
-
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        job = submit_analysis(parse_pair(request.args), parse_params(None))
+    except (ValueError, FileNotFoundError, jobs.QueueFullError) as e:
+        return submit_error_response(e)
 
-import time
+    job = jobs.wait(job["id"], MAX_WAIT_SECONDS)
+    if job["status"] not in jobs.FINISHED:
+        return jsonify(job_response(job)), 202
+    if job["status"] == "failed":
+        return jsonify({"status": "error", "message": job["error"]}), 500
 
-def delete_temp_results():
-    temp_results_path = BASE_PATH / "temp_results"
-    if temp_results_path.exists():
-        try:
-            # Close all open file handles (Windows issue)
-            for file in temp_results_path.rglob("*"):
-                try:
-                    with open(file, 'rb') as f:
-                        pass  # Just attempt to open and close it
-                except Exception:
-                    pass
-
-            # Give time for release
-            time.sleep(1)
-
-            # Now try deleting
-            shutil.rmtree(temp_results_path)
-            print("Deleted temp_results folder after all images served.")
-        except Exception as e:
-            print(f"Error deleting temp_results: {e}")
-
-
-@app.route('/temp_results/savis/<path:filename>')
-def serve_savis(filename):
-    global image_request_count
-    response = send_from_directory(BASE_PATH / "temp_results/savis", filename)
-    image_request_count += 1
-    if image_request_count >= TOTAL_IMAGES:
-        delete_temp_results()
-    return response
+    response_data = job_response(job)
+    response_data["status"] = "success"
+    return jsonify(response_data)
 
-@app.route('/temp_results/ndvis/<path:filename>')
-def serve_ndvis(filename):
-    global image_request_count
-    response = send_from_directory(BASE_PATH / "temp_results/ndvis", filename)
-    image_request_count += 1
-    if image_request_count >= TOTAL_IMAGES:
-        delete_temp_results()
+@app.route('/results/<key>/<digest>/<path:filename>')
+def serve_results(key, digest, filename):
+    """Serve a result file under its content-addressed URL, with a strong ETag, Range support and immutable caching."""
+    if not CACHE_KEY_PATTERN.fullmatch(key):
+        return jsonify({"status": "error", "message": "Result not found"}), 404
+    # The file is opened under the lease; an open file keeps streaming if the entry is evicted afterwards
+    with result_cache.lease(key):
+        file_digest = (result_cache.load_manifest(key) or {}).get(filename)
+        if file_digest is None or len(digest) < URL_DIGEST_LENGTH or not file_digest.startswith(digest):
+            return jsonify({"status": "error", "message": "Result not found"}), 404
+        response = send_from_directory(result_cache.CACHE_PATH, f"{key}/{filename}", etag=file_digest, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
     return response
 
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.png')
+def serve_tile(layer, z, x, y):
+    """Serve a 256x256 Web Mercator tile of a scene's ndvi/savi (?folder=scene) or a pair's ndvi_change/savi_change.
+
+    Pairs are given as ?folder=start_end, or ?start_folder=...&end_folder=... for scene names with underscores.
+    """
+    args = request.args
+    try:
+        png = tiles.get_tile(layer, args.get("folder") or args.get("start_folder"), z, x, y, args.get("end_folder"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    return Response(png, mimetype="image/png")
+
+@app.route('/zonal-stats', methods=['POST'])
+def zonal_statistics():
+    """Return per-polygon deforested pixel counts, areas and percentages of an analysed folder pair for GeoJSON polygons (404 until analysed)."""
+    data = request.get_json(silent=True) or {}
+    try:
+        folders = parse_pair(data)
+        polygons = zonal.zonal_stats(*folders, data.get("geojson"), parse_params(data.get("params")), data.get("crs", zonal.GEOJSON_CRS))
+    except (ValueError, FileNotFoundError) as e:
+        return submit_error_response(e)
+    return jsonify({"status": "success", "polygons": polygons})
+
+@app.route('/baselines/<name>', methods=['GET'])
+def get_baseline(name):
+    """Return the grid, parameters and folded scenes, with their results, of a per-pixel baseline."""
+    try:
+        return jsonify({"status": "success", "baseline": baseline.baseline_info(name)})
+    except (ValueError, FileNotFoundError) as e:
+        return submit_error_response(e)
+
+@app.route('/baselines/<name>', methods=['POST'])
+def update_baseline(name):
+    """Queue the comparison of a scene folder with a per-pixel baseline and its folding in, and return the job id.
+
+    The first folder creates the baseline. Body: {"folder": ..., "params": {...}, "statistic": "median" or "max", "min_observations": n}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job = submit_baseline_update(name, data)
+    except (ValueError, FileNotFoundError, jobs.QueueFullError) as e:
+        return submit_error_response(e)
+    return jsonify(job_response(job)), 202
+
+@app.route('/metrics', methods=['GET'])
+def serve_metrics():
+    """Expose request latencies, analysis stage totals, cache lookups and the job queue in the Prometheus text format."""
+    gauges = [("ndvi_jobs", {"status": status}, count) for status, count in jobs.in_flight().items()]
+    gauges.append(("ndvi_process_peak_rss_bytes", {}, int(ndvi_calc.peak_rss_mb() * 1024 * 1024)))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 @app.route('/get-folders', methods=['GET'])
 def get_folders():
+    """List the scene folders with their metadata from the catalog.
+
+    ?overlaps=<scene> keeps the scenes overlapping a scene, ?bbox=left,bottom,right,top (WGS84,
+    or ?crs=) the scenes intersecting a box.
+    """
     try:
-        folders = [f for f in os.listdir(DATA_FOLDER) if os.path.isdir(os.path.join(DATA_FOLDER, f))]
-        return jsonify({"folders": sorted(folders)})  # Sorted for consistency
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        scenes = catalog.list_scenes()
+        if request.args.get("overlaps"):
+            names = set(catalog.overlapping(scene=request.args["overlaps"]))
+            scenes = [scene for scene in scenes if scene["name"] in names]
+        if request.args.get("bbox"):
+            bounds = [float(value) for value in request.args["bbox"].split(",")]
+            if len(bounds) != 4:
+                raise ValueError("Expected bbox=left,bottom,right,top")
+            names = set(catalog.overlapping(bounds, crs=request.args.get("crs", catalog.INDEX_CRS)))
+            scenes = [scene for scene in scenes if scene["name"] in names]
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Band identities hold server paths, only the metadata is listed
+    scenes = [{name: value for name, value in scene.items() if name != "bands"} for scene in scenes]
+    return jsonify({"folders": [scene["name"] for scene in scenes], "scenes": scenes})
 
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""Locates the bands of a scene, wherever they are stored.
+
+Bands are named in config.json ("red", "nir", ...) after their Landsat band number. A scene
+named <name> in the input folder is either:
+
+    <name>/band4.TIF, <name>/band5.TIF     extracted bands, band<number>.TIF
+    <name>.tar, <name>.tar.gz, <name>.zip  a Landsat archive, read in place through /vsitar/ or /vsizip/
+    <name>.json                            {"red": ..., "nir": ...} with HTTP(S) URLs or GDAL paths
+
+Archive members and URLs are opened through GDAL's virtual filesystems, so windowed reads only
+fetch the blocks they need. Plain .tar and stored .zip members are read at random; .tar.gz
+members have to be decompressed from the start.
+"""
+import hashlib
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from contextlib import ExitStack
+from pathlib import Path
+
+BASE_PATH = Path(__file__).resolve().parent
+
+with open(BASE_PATH / 'config.json', 'r') as f:
+    config = json.load(f)
+
+DATA_FOLDER = BASE_PATH / config["input_folder"]
+ARCHIVE_PREFIXES = {".tar": "/vsitar/", ".tar.gz": "/vsitar/", ".tgz": "/vsitar/", ".zip": "/vsizip/"}
+REMOTE_SUFFIX = ".json"
+# Band name -> Landsat 8/9 band number
+BAND_NUMBERS = config["bands"]
+MTL_MEMBER = re.compile(r"MTL\.txt$", re.IGNORECASE)
+ARCHIVE_PATH = re.compile(r"^/vsi(?:tar|zip)/(.+?\.(?:tar\.gz|tgz|tar|zip))/")
+HTTP_TIMEOUT_SECONDS = 30
+# Remote identities are reused this long, so cache keys of tiles and jobs don't each cost a HEAD request
+IDENTITY_TTL_SECONDS = config["remote_io"]["identity_ttl_seconds"]
+
+# GDAL reads these as config options: a large range-request chunk doubles as block prefetch,
+# and downloaded chunks are kept in an LRU shared by every /vsicurl/ file
+REMOTE_IO = config["remote_io"]
+GDAL_OPTIONS = {
+    "CPL_VSIL_CURL_CHUNK_SIZE": str(REMOTE_IO["chunk_kb"] * 1024),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(REMOTE_IO["cache_mb"] * 1024 * 1024),
+    "GDAL_INGESTED_BYTES_AT_OPEN": str(REMOTE_IO["header_kb"] * 1024),
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(REMOTE_IO["block_cache_mb"] * 1024 * 1024),
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    # Don't list the remote directory to look for sidecar files
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+}
+for name, value in GDAL_OPTIONS.items():
+    # Set before GDAL first reads them; the environment still wins
+    os.environ.setdefault(name, value)
+
+# (archive path, size, mtime) -> member names, as listing a .tar reads every header
+_members = {}
+# URL -> (monotonic expiry, identity) of remote files
+_identities = {}
+_lock = threading.Lock()
+
+def archive_members(archive):
+    stat = os.stat(archive)
+    key = (str(archive), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if key in _members:
+            return _members[key]
+    if archive.suffix == ".zip":
+        with zipfile.ZipFile(archive) as zf:
+            members = [info.filename for info in zf.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(archive) as tf:
+            members = [info.name for info in tf if info.isfile()]
+    with _lock:
+        _members[key] = members
+    return members
+
+def archive_source(name, data_folder=DATA_FOLDER):
+    """Returns the archive holding a scene and its GDAL prefix, or (None, None)."""
+    for suffix, prefix in ARCHIVE_PREFIXES.items():
+        archive = data_folder / f"{name}{suffix}"
+        if archive.is_file():
+            return archive, prefix
+    return None, None
+
+def gdal_path(location, relative_to):
+    """Returns the GDAL path of a band given as a URL, a GDAL virtual path or a local path."""
+    if location.startswith(("http://", "https://")):
+        return f"/vsicurl/{location}"
+    if location.startswith("/vsi"):
+        return location
+    return relative_to / location
+
+def member_pattern(band):
+    """Matches the archive member of a band: Landsat names (..._B4.TIF, ..._SR_B4.TIF) or band4.TIF."""
+    return re.compile(rf"(?:^|[/_])(?:B|band){BAND_NUMBERS[band]}\.TIF$", re.IGNORECASE)
+
+def scene_bands(name, bands, data_folder=DATA_FOLDER):
+    """Returns {band name: path} of the given bands of a scene, with Paths for extracted bands and GDAL paths otherwise.
+
+    Raises FileNotFoundError when no source of the scene exists.
+    """
+    folder = data_folder / name
+    if folder.is_dir():
+        return {band: folder / f"band{BAND_NUMBERS[band]}.TIF" for band in bands}
+
+    archive, prefix = archive_source(name, data_folder)
+    if archive is not None:
+        members = archive_members(archive)
+        paths = {}
+        for band in bands:
+            matches = [member for member in members if member_pattern(band).search(member)]
+            if len(matches) != 1:
+                raise FileNotFoundError(f"Expected one {band} band in {archive}, found {len(matches)}")
+            paths[band] = f"{prefix}{archive}/{matches[0]}"
+        return paths
+
+    remote = data_folder / f"{name}{REMOTE_SUFFIX}"
+    if remote.is_file():
+        with open(remote, 'r') as f:
+            locations = json.load(f)
+        if not isinstance(locations, dict) or not all(isinstance(locations.get(band), str) for band in bands):
+            raise FileNotFoundError(f"Expected {', '.join(bands)} band locations in {remote}")
+        return {band: gdal_path(locations[band], data_folder) for band in bands}
+
+    raise FileNotFoundError(f"Scene not found: {name}")
+
+def list_scenes(data_folder=DATA_FOLDER):
+    """Returns the names of the scene folders, archives and remote scene files in the input folder."""
+    names = set()
+    if not data_folder.exists():
+        return []
+    for entry in os.scandir(data_folder):
+        if entry.is_dir():
+            names.add(entry.name)
+            continue
+        for suffix in (*ARCHIVE_PREFIXES, REMOTE_SUFFIX):
+            if entry.name.endswith(suffix) and len(entry.name) > len(suffix):
+                names.add(entry.name[:-len(suffix)])
+                break
+    return sorted(names)
+
+def mtl_text(name, data_folder=DATA_FOLDER):
+    """Returns the contents of a scene's Landsat MTL metadata file, or None."""
+    folder = data_folder / name
+    if folder.is_dir():
+        path = next(iter(sorted(folder.glob("*MTL.txt"))), None)
+        return None if path is None else path.read_text(errors="ignore")
+
+    archive, _ = archive_source(name, data_folder)
+    if archive is None:
+        return None
+    member = next((member for member in archive_members(archive) if MTL_MEMBER.search(member)), None)
+    if member is None:
+        return None
+    if archive.suffix == ".zip":
+        with zipfile.ZipFile(archive) as zf:
+            return zf.read(member).decode(errors="ignore")
+    with tarfile.open(archive) as tf:
+        return tf.extractfile(member).read().decode(errors="ignore")
+
+def file_checksum(band, chunk_size=8 * 1024 * 1024):
+    """Returns the sha256 of a local band or archive member, or None for a remote one, which is never downloaded whole."""
+    band = str(band)
+    archive = ARCHIVE_PATH.match(band)
+    if band.startswith("/vsicurl/") or (archive and archive.group(1).startswith("/vsicurl/")):
+        return None
+
+    digest = hashlib.sha256()
+    with ExitStack() as stack:
+        if archive is None:
+            f = stack.enter_context(open(band, 'rb'))
+        elif archive.group(1).endswith(".zip"):
+            f = stack.enter_context(stack.enter_context(zipfile.ZipFile(archive.group(1))).open(band[archive.end():]))
+        else:
+            f = stack.enter_context(tarfile.open(archive.group(1))).extractfile(band[archive.end():])
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def remote_identity(url):
+    """Identifies a remote file by its size and ETag (or Last-Modified) from a HEAD request.
+
+    Identities are cached for identity_ttl_seconds, so a file replaced remotely is noticed that late.
+    """
+    with _lock:
+        cached = _identities.get(url)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=HTTP_TIMEOUT_SECONDS) as response:
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        raise FileNotFoundError(f"{url}: HTTP {e.code}")
+    except urllib.error.URLError as e:
+        raise FileNotFoundError(f"{url}: {e.reason}")
+    identity = [headers.get("Content-Length"), headers.get("ETag") or headers.get("Last-Modified")]
+    with _lock:
+        _identities[url] = (time.monotonic() + IDENTITY_TTL_SECONDS, identity)
+    return identity
+
+def band_identity(band):
+    """Identifies a band by path, size and modification time (or ETag) without reading it.
+
+    Archive members are identified by their archive, remote bands by a HEAD request.
+    """
+    band = str(band)
+    archive = ARCHIVE_PATH.match(band)
+    container = archive.group(1) if archive else band
+    if container.startswith("/vsicurl/"):
+        return [band, *remote_identity(container[len("/vsicurl/"):])]
+    stat = os.stat(container)
+    return [band, stat.st_size, stat.st_mtime_ns]
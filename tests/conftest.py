@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# The modules live at the repository root, next to config.json
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+@pytest.fixture
+def write_band(tmp_path):
+    """Writes a 2D array as a single-band 30 m UTM GeoTIFF (a COG with cog=True) and returns its path.
+
+    The raster's top left corner is at (500000, 9000000) unless another transform is given.
+    """
+    def write(name, data, cog=False, nodata=None, transform=None):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile = {"driver": "COG" if cog else "GTiff", "width": data.shape[1], "height": data.shape[0], "count": 1,
+                   "dtype": data.dtype, "crs": "EPSG:32621", "transform": transform or from_origin(500000, 9000000, 30, 30), "nodata": nodata}
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(data, 1)
+        return path
+    return write
+
+@pytest.fixture
+def synthetic_bands():
+    """Returns red and nir uint16 reflectances with a vegetated left half and a bare right half."""
+    red = np.full((64, 64), 1000, dtype=np.uint16)
+    nir = np.full((64, 64), 4000, dtype=np.uint16)
+    nir[:, 32:] = 1200
+    return red, nir
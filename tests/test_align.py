@@ -0,0 +1,91 @@
+from contextlib import ExitStack
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import ndvi_calc
+import nvdiOgscript
+
+# The new raster starts 13 rows below and 37 columns right of the old one, off any block boundary
+ROWS, COLS = 13, 37
+SHIFTED = from_origin(500000 + COLS * 30, 9000000 - ROWS * 30, 30, 30)
+# The overlap on the old raster's 100 x 80 grid
+OVERLAP = Window(COLS, ROWS, 80 - COLS, 100 - ROWS)
+
+def test_overlap_window_of_shifted_rasters(write_band):
+    old = write_band("old.tif", np.zeros((100, 80), dtype=np.float32))
+    new = write_band("new.tif", np.zeros((120, 90), dtype=np.float32), transform=SHIFTED)
+    with rasterio.open(old) as old_src, rasterio.open(new) as new_src:
+        assert ndvi_calc.overlap_window(old_src, [new_src]) == OVERLAP
+        # Seen from the new raster, the overlap is its top left corner
+        assert ndvi_calc.overlap_window(new_src, [old_src]) == Window(0, 0, 80 - COLS, 100 - ROWS)
+
+@pytest.mark.parametrize("transform", [from_origin(500000 + 80 * 30, 9000000, 30, 30), from_origin(600000, 8000000, 30, 30)])
+def test_rasters_without_overlap_are_rejected(write_band, transform):
+    old = write_band("old.tif", np.zeros((100, 80), dtype=np.float32))
+    # The first one only shares the old raster's right edge
+    new = write_band("new.tif", np.zeros((100, 80), dtype=np.float32), transform=transform)
+    with rasterio.open(old) as old_src, rasterio.open(new) as new_src, pytest.raises(ValueError):
+        ndvi_calc.overlap_window(old_src, [new_src])
+
+def test_same_grid_is_read_at_an_offset(write_band):
+    old_data = np.arange(100 * 80, dtype=np.float32).reshape(100, 80)
+    new_data = -np.arange(120 * 90, dtype=np.float32).reshape(120, 90)
+    old = write_band("old.tif", old_data)
+    new = write_band("new.tif", new_data, transform=SHIFTED)
+    tile = Window(5, 7, 11, 3)
+    with rasterio.open(old) as old_src, rasterio.open(new) as new_src, ExitStack() as stack:
+        old_aligned = ndvi_calc.aligned_source(old_src, old_src, OVERLAP, stack)
+        new_aligned = ndvi_calc.aligned_source(new_src, old_src, OVERLAP, stack)
+        # No resampling: the datasets themselves are read, at the overlap's offset into each
+        assert old_aligned == (old_src, (ROWS, COLS)) and new_aligned == (new_src, (0, 0))
+        np.testing.assert_array_equal(ndvi_calc.read_aligned(old_aligned, tile), old_data[ROWS + 7:ROWS + 10, COLS + 5:COLS + 16])
+        np.testing.assert_array_equal(ndvi_calc.read_aligned(new_aligned, tile), new_data[7:10, 5:16])
+
+def test_other_grid_is_resampled_bilinearly(write_band):
+    old = write_band("old.tif", np.zeros((20, 30), dtype=np.float32))
+    # Shifted half a pixel east, with values equal to their column
+    new_data = np.tile(np.arange(30, dtype=np.float32), (20, 1))
+    new = write_band("new.tif", new_data, transform=from_origin(500015, 9000000, 30, 30))
+    with rasterio.open(old) as old_src, rasterio.open(new) as new_src, ExitStack() as stack:
+        grid = ndvi_calc.overlap_window(old_src, [new_src])
+        assert grid == Window(1, 0, 29, 20)
+        aligned = ndvi_calc.aligned_source(new_src, old_src, grid, stack)
+        assert aligned[0] is not new_src and aligned[1] == (0, 0)
+        data = ndvi_calc.read_aligned(aligned, Window(0, 0, grid.width, grid.height))
+    # Old column c sits halfway between new columns c - 1 and c
+    np.testing.assert_allclose(data[:, 1:-1], np.tile(np.arange(2, 29, dtype=np.float32) - 0.5, (20, 1)), atol=1e-4)
+
+def shifted_pair(write_band, name, old_value, new_value):
+    """Writes old and new index rasters whose values outside the overlap would stand out in any change."""
+    old_data = np.full((100, 80), old_value, dtype=np.float32)
+    old_data[:ROWS] = old_data[:, :COLS] = 9
+    new_data = np.full((120, 90), new_value, dtype=np.float32)
+    new_data[100 - ROWS:] = new_data[:, 80 - COLS:] = -9
+    return write_band(f"old/{name}.tif", old_data), write_band(f"new/{name}.tif", new_data, transform=SHIFTED)
+
+@pytest.mark.parametrize("compare_indices", [ndvi_calc.compare_indices, nvdiOgscript.compare_indices])
+def test_compare_indices_covers_only_the_overlap(write_band, tmp_path, compare_indices):
+    old, new = shifted_pair(write_band, "ndvi", 0.5, 0.2)
+    compare_indices(old, new, tmp_path / "change.tif")
+    with rasterio.open(tmp_path / "change.tif") as src:
+        assert (src.height, src.width) == (OVERLAP.height, OVERLAP.width)
+        assert src.transform == SHIFTED
+        np.testing.assert_allclose(src.read(1), -0.3, atol=1e-6)
+
+def test_detect_change_counts_only_overlapping_pixels(write_band, tmp_path):
+    for name in ndvi_calc.CHANGE_THRESHOLDS:
+        shifted_pair(write_band, name, 0.6, 0.6)
+        # A cleared patch of 4 x 6 pixels inside the overlap
+        with rasterio.open(tmp_path / "new" / f"{name}.tif", "r+") as dst:
+            dst.write(np.full((4, 6), 0.1, dtype=np.float32), 1, window=Window(20, 30, 6, 4))
+    result = ndvi_calc.detect_change(tmp_path / "old", tmp_path / "new", {"ndvi_change": tmp_path / "ndvi_change.tif"}, tile_memory_mb=0.01)
+    assert result == {"deforested_pixels": 4 * 6, "total_pixels": OVERLAP.height * OVERLAP.width}
+    with rasterio.open(tmp_path / "ndvi_change.tif") as src:
+        assert src.transform == SHIFTED
+        change = src.read(1)
+    np.testing.assert_allclose(change[30:34, 20:26], -0.5, atol=1e-6)
+    assert np.count_nonzero(np.abs(change) > 1e-6) == 4 * 6
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import baseline
+
+nan = np.nan
+
+def fold_all(values, observations=4):
+    """Folds a sequence of per-pixel value arrays into empty observations, oldest first."""
+    stack = np.full((observations, len(values[0])), nan, dtype=np.float32)
+    count = np.zeros(len(values[0]), dtype=np.int64)
+    for value in values:
+        stack, count = baseline.fold_observation(stack, count, np.asarray(value, dtype=np.float32))
+    return stack, count
+
+def test_fold_keeps_the_latest_observations_in_order():
+    stack, count = fold_all([[1.0], [2.0], [3.0], [4.0], [5.0], [6.0]])
+    assert count.tolist() == [4]
+    # The oldest observations are dropped first
+    assert stack[:, 0].tolist() == [3.0, 4.0, 5.0, 6.0]
+
+def test_fold_skips_invalid_values():
+    stack, count = fold_all([[1.0, 1.0], [nan, 2.0], [3.0, nan]])
+    assert count.tolist() == [2, 2]
+    np.testing.assert_array_equal(stack[-2:], [[1.0, 1.0], [3.0, 2.0]])
+    assert np.isnan(stack[:2]).all()
+
+@pytest.mark.parametrize("kept", [[0.4], [0.4, 0.1], [0.4, 0.1, 0.7], [0.4, 0.1, 0.7, 0.2]])
+def test_statistic_reads_median_and_max_of_kept_observations(kept):
+    stack, count = fold_all([[value] for value in kept])
+    median = baseline.baseline_statistic(stack, count, "median")
+    maximum = baseline.baseline_statistic(stack, count, "max")
+    assert median[0] == pytest.approx(np.median(kept))
+    assert maximum[0] == pytest.approx(max(kept))
+
+def test_statistic_is_per_pixel_with_uneven_counts():
+    stack, count = fold_all([[0.5, nan, 0.9], [0.1, 0.3, nan], [0.2, nan, nan]])
+    assert count.tolist() == [3, 1, 1]
+    np.testing.assert_allclose(baseline.baseline_statistic(stack, count, "median"), [0.2, 0.3, 0.9])
+    np.testing.assert_allclose(baseline.baseline_statistic(stack, count, "max"), [0.5, 0.3, 0.9])
+
+def test_statistic_without_observations_is_nan():
+    stack, count = fold_all([[nan]])
+    assert np.isnan(baseline.baseline_statistic(stack, count, "median")[0])
+    assert np.isnan(baseline.baseline_statistic(stack, count, "max")[0])
+
+@pytest.mark.parametrize("name", ["../escape", "", ".hidden", "a/b", None])
+def test_baseline_names_are_plain_folder_names(name):
+    with pytest.raises(ValueError):
+        baseline.baseline_path(name)
+
+def test_scenes_fold_in_acquisition_order():
+    params = baseline.ndvi_calc.ANALYSIS_PARAMS
+    state = {"params": baseline.storage_params(params["L"]),
+             "scenes": [{"scene_key": "k1", "acquired": "2020-01-01"}, {"scene_key": "k2", "acquired": "2021-06-01"}]}
+    assert baseline.folded_entry("b", state, "new", {"acquired": "2022-01-01"}, "k3", params) is None
+    # Undated scenes can't be ordered, so they are taken
+    assert baseline.folded_entry("b", state, "undated", {"acquired": None}, "k4", params) is None
+    # A scene folded already returns its recorded entry, even though it is older than the latest one
+    assert baseline.folded_entry("b", state, "old", {"acquired": "2020-01-01"}, "k1", params) is state["scenes"][0]
+    with pytest.raises(ValueError, match="before the latest scene"):
+        baseline.folded_entry("b", state, "late", {"acquired": "2021-01-01"}, "k5", params)
+    with pytest.raises(ValueError, match="other index parameters"):
+        baseline.folded_entry("b", state, "new", {"acquired": "2022-01-01"}, "k3", dict(params, L=params["L"] + 1))
@@ -0,0 +1,30 @@
+import pytest
+
+import batch
+
+SCENES = [
+    {"name": "s1", "acquired": "2019-12-31"},
+    {"name": "s2", "acquired": "2020-01-01"},
+    {"name": "s3", "acquired": "2023-05-01"},
+    {"name": "s4", "acquired": "2023-12-31"},
+    {"name": "s5", "acquired": "2024-01-01"},
+    {"name": "undated", "acquired": None},
+]
+
+@pytest.fixture(autouse=True)
+def catalog_scenes(monkeypatch):
+    monkeypatch.setattr(batch.catalog, "list_scenes", lambda: SCENES)
+
+@pytest.mark.parametrize("start, end, expected", [
+    ("2020", "2023", ["s2", "s3", "s4"]),
+    ("2023-05", "2023-05", ["s3"]),
+    ("2020-01-01", "2023-12-31", ["s2", "s3", "s4"]),
+    ("2020-01-02", "2023-12-30", ["s3"]),
+    (None, "2019", ["s1"]),
+    ("2024", None, ["s5", "undated"]),
+])
+def test_list_folders_treats_bounds_as_date_prefixes(start, end, expected):
+    assert batch.list_folders(start, end) == expected
+
+def test_list_folders_without_bounds_keeps_every_scene():
+    assert batch.list_folders() == [scene["name"] for scene in SCENES]
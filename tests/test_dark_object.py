@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import rasterio
+
+import nvdiOgscript
+
+@pytest.mark.parametrize("q", [0, 1, 37.5, 50, 99, 100])
+def test_histogram_percentile_matches_numpy(q):
+    values = np.random.default_rng(8).integers(0, 300, size=1001)
+    counts = np.bincount(values, minlength=300)
+    assert nvdiOgscript.histogram_percentile(counts, q) == pytest.approx(np.percentile(values, q))
+
+def test_histogram_percentile_interpolates_across_empty_bins():
+    # 1st percentile of [0]*5 + [10]*95 sits between the 5th and 6th smallest values, so between bins 0 and 10
+    counts = np.zeros(11, dtype=np.int64)
+    counts[0], counts[10] = 5, 95
+    values = np.repeat([0, 10], [5, 95])
+    assert nvdiOgscript.histogram_percentile(counts, 5) == pytest.approx(np.percentile(values, 5))
+
+def test_histogram_percentile_of_empty_histogram_is_nan():
+    assert np.isnan(nvdiOgscript.histogram_percentile(np.zeros(4, dtype=np.int64), 1))
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+def test_dark_object_value_streams_tiles(write_band, dtype):
+    info = np.iinfo(dtype)
+    data = np.random.default_rng(1).integers(max(info.min, -2000), min(info.max, 5000), size=(300, 200)).astype(dtype)
+    path = write_band(f"band_{np.dtype(dtype).name}.tif", data)
+    with rasterio.open(path) as src:
+        # A budget of a few rows forces many tiles
+        value = nvdiOgscript.dark_object_value(src, tile_memory_mb=0.05)
+    assert value == pytest.approx(np.percentile(data, 1))
+
+def test_dark_object_subtraction_clamps_at_zero_and_keeps_nan():
+    band = np.array([5, 10, 20, np.nan], dtype=np.float32)
+    nvdiOgscript.dark_object_subtraction(band, 10)
+    np.testing.assert_array_equal(band, [0, 0, 10, np.nan])
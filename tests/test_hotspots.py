@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import ndvi_calc
+
+TRANSFORM = from_origin(500000, 9000000, 30, 30)
+CRS_UTM = CRS.from_epsg(32621)
+
+def summarize(mask, tile_height, tile_width, cell_pixels=8):
+    """Feeds mask to the hotspot accumulator in tiles, row by row and left to right, like detect_change."""
+    hotspots = ndvi_calc.new_hotspots(*mask.shape, cell_pixels=cell_pixels)
+    for row in range(0, mask.shape[0], tile_height):
+        for col in range(0, mask.shape[1], tile_width):
+            window = Window(col, row, min(tile_width, mask.shape[1] - col), min(tile_height, mask.shape[0] - row))
+            ndvi_calc.add_hotspot_tile(hotspots, window, np.ascontiguousarray(mask[window.toslices()]))
+    return ndvi_calc.hotspot_summary(hotspots, TRANSFORM, CRS_UTM, top_k=1000)
+
+def test_edge_joins_include_diagonal_neighbours():
+    labels = np.array([3, -1, -1, 4])
+    # Padded by one on each side: the neighbours of labels[i] are neighbours[i:i + 3]
+    neighbours = np.array([-1, -1, 7, -1, -1, 8])
+    joins = {tuple(pair) for pair in ndvi_calc.edge_joins(labels, neighbours).tolist()}
+    assert joins == {(3, 7), (4, 8)}
+
+def test_edge_joins_ignore_background():
+    assert len(ndvi_calc.edge_joins(np.array([-1, -1]), np.array([5, 5, 5, 5]))) == 0
+
+@pytest.mark.parametrize("tile_height, tile_width", [(64, 64), (16, 64), (16, 16), (7, 11)])
+def test_patches_merge_across_tiles(tile_height, tile_width):
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[10:50, 14:18] = True     # a bar crossing horizontal tile edges
+    mask[30:33, 5:60] = True      # joined to it, crossing vertical ones
+    for i in range(18):           # a diagonal line, only 8-connected
+        mask[44 + i, 40 + i] = True
+    mask[0:3, 0:3] = True         # a separate patch in a corner
+
+    summary = summarize(mask, tile_height, tile_width)
+    count, labels = cv2.connectedComponents(mask.view(np.uint8), connectivity=8)
+    expected = sorted(np.bincount(labels.ravel())[1:].tolist(), reverse=True)
+
+    assert summary["patch_count"] == count - 1
+    assert [patch["deforested_pixels"] for patch in summary["patches"]] == expected
+
+def test_patch_bounds_span_tiles():
+    mask = np.zeros((40, 40), dtype=bool)
+    mask[5:35, 12] = True
+    summary = summarize(mask, 10, 10)
+    assert summary["patch_count"] == 1
+    patch = summary["patches"][0]
+    assert patch["window"] == [5, 12, 30, 1]
+    assert patch["deforested_area_m2"] == pytest.approx(30 * 30 * 30)
+
+def test_cells_count_pixels_regardless_of_tiling():
+    mask = np.random.default_rng(18).random((50, 45)) > 0.7
+    cells = np.array(summarize(mask, 13, 9, cell_pixels=8)["cells"])
+    expected = np.add.reduceat(np.add.reduceat(mask, np.arange(0, 45, 8), axis=1), np.arange(0, 50, 8), axis=0)
+    np.testing.assert_array_equal(cells, expected)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import rasterio
+
+import ndvi_calc
+
+SCALE = ndvi_calc.INDEX_SCALE
+NODATA = ndvi_calc.INDEX_NODATA
+
+@pytest.mark.parametrize("threshold", [-0.2, -0.15, 0.0, 0.3, -0.00005, 1.23456])
+def test_scaled_threshold_matches_float_comparison(threshold):
+    stored = np.arange(-20000, 20000, dtype=np.int16)
+    limit = ndvi_calc.scaled_threshold(threshold, SCALE)
+    np.testing.assert_array_equal(stored < limit, np.round(stored * SCALE, 6) < threshold)
+
+def test_encode_decode_round_trip_keeps_nan_as_nodata():
+    values = np.array([-1.0, -0.2, 0.0, 0.12345, 1.5, np.nan], dtype=np.float32)
+    encoded = ndvi_calc.encode_index(values, SCALE)
+    assert encoded.dtype == np.int16
+    assert encoded[-1] == NODATA
+    decoded = ndvi_calc.decode_index(encoded, SCALE)
+    assert np.isnan(decoded[-1])
+    np.testing.assert_allclose(decoded[:-1], values[:-1], atol=SCALE / 2)
+
+def test_encode_never_produces_nodata_for_valid_values():
+    encoded = ndvi_calc.encode_index(np.array([-10.0, 10.0], dtype=np.float32), SCALE)
+    np.testing.assert_array_equal(encoded, [-32767, 32767])
+
+def test_float_storage_is_passed_through():
+    values = np.array([0.5, np.nan], dtype=np.float32)
+    assert ndvi_calc.encode_index(values, None) is values
+    assert ndvi_calc.decode_index(values, None) is values
+
+def test_scaled_change_propagates_nodata_and_clips():
+    new = np.array([100, NODATA, 30000, -30000, 5], dtype=np.int16)
+    old = np.array([300, 50, -30000, 30000, NODATA], dtype=np.int16)
+    change = ndvi_calc.scaled_change(new, old)
+    assert change.dtype == np.int16
+    np.testing.assert_array_equal(change, [-200, NODATA, 32767, -32767, NODATA])
+
+def test_storage_scale_recognises_scaled_rasters(write_band):
+    path = write_band("scaled.tif", np.array([[NODATA, 1200]], dtype=np.int16), nodata=NODATA)
+    with rasterio.open(path, "r+") as dst:
+        dst.scales = (SCALE,)
+    with rasterio.open(path) as src:
+        assert ndvi_calc.storage_scale(src) == pytest.approx(SCALE)
+        decoded = ndvi_calc.decode_index(src.read(1), ndvi_calc.storage_scale(src))
+    assert np.isnan(decoded[0, 0]) and decoded[0, 1] == pytest.approx(0.12)
+
+    plain = write_band("plain.tif", np.array([[0.5]], dtype=np.float32))
+    with rasterio.open(plain) as src:
+        assert ndvi_calc.storage_scale(src) is None
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import ndvi_calc
+
+def run(kernel, bands, L=0.5):
+    """Runs a kernel's ufunc steps on copies of the band tiles."""
+    height, width = next(iter(bands.values())).shape
+    out = ndvi_calc.tile_buffers(ndvi_calc.kernel_buffers(kernel, height * width), height, width)
+    for band, data in bands.items():
+        out[band][...] = data
+    return {name: value.copy() for name, value in ndvi_calc.run_kernel(kernel, out, L).items()}
+
+@pytest.fixture(autouse=True)
+def numpy_steps(monkeypatch):
+    # The compiled steps are what is under test, not numexpr
+    monkeypatch.setattr(ndvi_calc, "USE_NUMEXPR", False)
+
+@pytest.fixture
+def bands():
+    rng = np.random.default_rng(22)
+    return {"red": rng.uniform(0.05, 0.3, (8, 9)).astype(np.float32), "nir": rng.uniform(0.2, 0.6, (8, 9)).astype(np.float32)}
+
+def test_default_indices_share_subexpressions_and_reuse_buffers(bands):
+    kernel = ndvi_calc.compile_kernel({"ndvi": "(nir - red) / (nir + red)", "savi": "(nir - red) / (nir + red + L) * (1 + L)"})
+    # nir - red and nir + red are computed once, and the dead red band holds intermediates
+    assert [step[0] for step in kernel["steps"]].count(np.subtract) == 1
+    assert [step[0] for step in kernel["steps"]].count(np.add) == 2
+    assert kernel["buffers"] == ["nir", "red", "ndvi", "savi", "~4"]
+
+    red, nir = bands["red"], bands["nir"]
+    result = run(kernel, bands)
+    np.testing.assert_allclose(result["ndvi"], (nir - red) / (nir + red), rtol=1e-6)
+    np.testing.assert_allclose(result["savi"], (nir - red) / (nir + red + 0.5) * 1.5, rtol=1e-6)
+
+def test_chain_needs_no_temporary_buffer(bands):
+    kernel = ndvi_calc.compile_kernel({"a": "((nir - red) * 2 + 1) * 3"})
+    assert kernel["buffers"] == ["nir", "red", "a"]
+    assert kernel["bytes_per_pixel"] == 4 * 3 + 4 + 4
+    np.testing.assert_allclose(run(kernel, bands)["a"], ((bands["nir"] - bands["red"]) * 2 + 1) * 3, rtol=1e-6)
+
+def test_band_read_later_is_not_overwritten(bands):
+    kernel = ndvi_calc.compile_kernel({"b": "nir - red", "c": "(nir - red) / (nir + red)", "a": "nir"})
+    result = run(kernel, bands)
+    np.testing.assert_array_equal(result["a"], bands["nir"])
+    np.testing.assert_allclose(result["b"], bands["nir"] - bands["red"], rtol=1e-6)
+    np.testing.assert_allclose(result["c"], (bands["nir"] - bands["red"]) / (bands["nir"] + bands["red"]), rtol=1e-6)
+
+def test_band_free_subexpressions_are_folded(bands):
+    kernel = ndvi_calc.compile_kernel({"a": "nir * (1 + L) - -red / 2"})
+    # nir * s, -red, / 2 and the subtraction; 1 + L is no step of its own
+    assert len(kernel["steps"]) == 4
+    np.testing.assert_allclose(run(kernel, bands, L=0.25)["a"], bands["nir"] * 1.25 + bands["red"] / 2, rtol=1e-6)
+
+def test_kernel_matches_numexpr(bands, monkeypatch):
+    pytest.importorskip("numexpr")
+    kernel = ndvi_calc.compile_kernel({"ndvi": "(nir - red) / (nir + red)", "x": "nir * nir - red"})
+    steps = run(kernel, bands)
+    monkeypatch.setattr(ndvi_calc, "USE_NUMEXPR", True)
+    evaluated = run(kernel, bands)
+    for name in steps:
+        np.testing.assert_allclose(steps[name], evaluated[name], rtol=1e-6)
+
+@pytest.mark.parametrize("expression", ["nir ** 2", "sqrt(nir)", "nir if red else 0", "blue_band + red", "nir +"])
+def test_unsupported_expressions_are_rejected(expression):
+    with pytest.raises(ValueError):
+        ndvi_calc.compile_kernel({"x": expression})
+
+def test_index_names_must_not_shadow_bands():
+    with pytest.raises(ValueError):
+        ndvi_calc.compile_kernel({"red": "nir - red"})
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+
+import pytest
+
+import result_cache
+
+def store(cache, key, age=0, size=1000):
+    """Stores an entry holding a file of size bytes, last used age seconds ago."""
+    def build(folder):
+        (folder / "preview.png").write_bytes(b"x" * size)
+        return {"key": key}
+    result_cache.store_result(key, build, cache)
+    used = time.time() - age
+    os.utime(cache / key / result_cache.RESULT_FILE, (used, used))
+
+def entries(cache):
+    return sorted(path.name for path in cache.iterdir() if path.is_dir() and not path.name.startswith("."))
+
+def test_store_and_load_result(tmp_path):
+    store(tmp_path, "a")
+    assert result_cache.load_result("a", tmp_path) == {"key": "a"}
+    assert (tmp_path / "a" / "preview.png").stat().st_size == 1000
+    assert result_cache.load_result("b", tmp_path) is None
+
+def test_failed_build_leaves_no_entry_behind(tmp_path):
+    def build(folder):
+        (folder / "preview.png").write_bytes(b"partial")
+        raise RuntimeError("build failed")
+    with pytest.raises(RuntimeError):
+        result_cache.store_result("a", build, tmp_path)
+    # Neither the entry nor its staging folder is left
+    assert list(tmp_path.iterdir()) == []
+    assert result_cache.load_result("a", tmp_path) is None
+
+def test_leased_entry_survives_evict(tmp_path):
+    store(tmp_path, "a", age=100)
+    store(tmp_path, "b")
+    with result_cache.lease("a", tmp_path):
+        result_cache.evict(tmp_path, 0, ttl_seconds=10)
+        assert entries(tmp_path) == ["a"]
+    result_cache.evict(tmp_path, 0)
+    assert entries(tmp_path) == []
+    # The lock files go with their entries
+    assert list((tmp_path / result_cache.LEASES_FOLDER).iterdir()) == []
+
+def test_size_limit_removes_least_recently_used_entries(tmp_path):
+    for age, key in ((30, "a"), (20, "b"), (10, "c")):
+        store(tmp_path, key, age)
+    size = result_cache.entry_size(tmp_path / "a")
+    result_cache.evict(tmp_path, 2 * size)
+    assert entries(tmp_path) == ["b", "c"]
+
+    # A hit moves the entry to the back of the line
+    result_cache.load_result("b", tmp_path)
+    result_cache.evict(tmp_path, size)
+    assert entries(tmp_path) == ["b"]
+
+def test_ttl_removes_expired_entries_and_abandoned_staging(tmp_path):
+    store(tmp_path, "a", age=1000)
+    store(tmp_path, "b", age=10)
+    abandoned, building = tmp_path / ".c-1", tmp_path / ".d-2"
+    abandoned.mkdir()
+    building.mkdir()
+    os.utime(abandoned, (time.time() - 1000, time.time() - 1000))
+    result_cache.evict(tmp_path, 10 ** 9, ttl_seconds=100)
+    assert entries(tmp_path) == ["b"]
+    assert not abandoned.exists() and building.exists()
+
+def test_sweep_once_evicts_both_caches_and_builds_manifests(tmp_path, monkeypatch):
+    results, scenes = tmp_path / "results", tmp_path / "scenes"
+    monkeypatch.setattr(result_cache, "CACHE_PATH", results)
+    monkeypatch.setattr(result_cache, "SCENE_CACHE_PATH", scenes)
+    for cache in (results, scenes):
+        store(cache, "old", age=1000)
+        store(cache, "new")
+    monkeypatch.setattr(result_cache, "CACHE_TTL_SECONDS", 100)
+    monkeypatch.setattr(result_cache, "SCENE_CACHE_TTL_SECONDS", 100)
+    result_cache.sweep_once()
+    assert entries(results) == entries(scenes) == ["new"]
+    with open(results / "new" / result_cache.MANIFEST_FILE) as f:
+        assert json.load(f) == {"preview.png": result_cache.file_digest(results / "new" / "preview.png")}
@@ -0,0 +1,148 @@
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+
+import cv2
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.warp import Resampling, reproject, transform_bounds
+
+import metrics
+import ndvi_calc
+import result_cache
+
+TILE_SIZE = 256
+TILE_CACHE_MAX_BYTES = ndvi_calc.config["tile_cache_mb"] * 1024 * 1024
+# Half-width of the Web Mercator square, in metres
+MERCATOR_ORIGIN = 20037508.342789244
+SCENE_LAYERS = tuple(ndvi_calc.INDEX_EXPRESSIONS)
+CHANGE_LAYERS = {f"{name}_change": name for name in ndvi_calc.INDEX_EXPRESSIONS}
+# Changes are drawn on a fixed stretch so tiles of different pairs are comparable
+CHANGE_RANGE = (-1.0, 1.0)
+
+_tiles = OrderedDict()
+_tiles_bytes = 0
+_lock = threading.Lock()
+
+def tile_bounds(z, x, y):
+    """Returns the Web Mercator (left, bottom, right, top) of an XYZ tile."""
+    size = 2 * MERCATOR_ORIGIN / 2 ** z
+    left, top = -MERCATOR_ORIGIN + x * size, MERCATOR_ORIGIN - y * size
+    return left, top - size, left + size, top
+
+def overview_level(src, bounds):
+    """Returns the coarsest overview level still at least as fine as the tile, or None for full resolution."""
+    left, _, right, _ = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+    src_res, tile_res = (right - left) / src.width, (bounds[2] - bounds[0]) / TILE_SIZE
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if src_res * factor <= tile_res:
+            level = i
+    return level
+
+def read_tile(path, bounds):
+    """Reads a raster into a TILE_SIZE x TILE_SIZE float32 Web Mercator tile, NaN where it has no data."""
+    with rasterio.open(path) as src:
+        left, bottom, right, top = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+        if left >= bounds[2] or right <= bounds[0] or bottom >= bounds[3] or top <= bounds[1]:
+            return np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+        level, scale = overview_level(src, bounds), ndvi_calc.storage_scale(src)
+
+    # Scaled int16 rasters are warped as stored and decoded afterwards
+    if scale:
+        tile, nodata = np.full((TILE_SIZE, TILE_SIZE), ndvi_calc.INDEX_NODATA, dtype=np.int16), ndvi_calc.INDEX_NODATA
+    else:
+        tile, nodata = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32), np.nan
+
+    # Low zooms read a decimated overview instead of the full-resolution raster
+    options = {} if level is None else {"overview_level": level}
+    with rasterio.open(path, **options) as src:
+        reproject(rasterio.band(src, 1), tile, dst_transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE), dst_crs="EPSG:3857",
+                  src_nodata=src.nodata, dst_nodata=nodata, resampling=Resampling.nearest)
+    return ndvi_calc.decode_index(tile, scale)
+
+def render_png(tile, min_val, max_val):
+    """Encodes a float tile as a PNG drawn like the quicklooks, with NaN pixels transparent."""
+    return cv2.imencode(".png", ndvi_calc.colorize(tile, min_val, max_val))[1].tobytes()
+
+def cached_scene(folder):
+    """Returns the scene cache key and metadata of an analysed folder, or raises FileNotFoundError."""
+    key = ndvi_calc.scene_key(folder)
+    scene = result_cache.load_result(key, result_cache.SCENE_CACHE_PATH)
+    if scene is None:
+        raise FileNotFoundError(f"Scene {folder} has not been analysed yet")
+    return key, scene
+
+@contextmanager
+def leased_scenes(*keys):
+    """Leases scene cache entries while their rasters are read, raising FileNotFoundError if one was evicted meanwhile."""
+    with ExitStack() as stack:
+        for key in keys:
+            stack.enter_context(result_cache.lease(key, result_cache.SCENE_CACHE_PATH))
+            if result_cache.load_result(key, result_cache.SCENE_CACHE_PATH) is None:
+                raise FileNotFoundError("Scene has been evicted from the cache")
+        yield
+
+def tile_source(layer, folder, z, x, y, end_folder=None):
+    """Returns the source key of a tile and a function rendering it to PNG bytes.
+
+    Scene layers draw a scene's cached index raster; change layers subtract two scenes' rasters,
+    of folder and end_folder, or of folder="start_end" for scene names without underscores.
+    """
+    bounds = tile_bounds(z, x, y)
+    if layer in SCENE_LAYERS:
+        if end_folder is not None:
+            raise ValueError("end_folder only applies to change layers")
+        key, scene = cached_scene(folder)
+        path, value_range = result_cache.SCENE_CACHE_PATH / key / f"{layer}.tif", scene[f"{layer}_range"]
+
+        def render():
+            with leased_scenes(key):
+                return render_png(read_tile(path, bounds), *value_range)
+        return key, render
+
+    if layer in CHANGE_LAYERS:
+        parts = [folder, end_folder] if end_folder is not None else folder.split("_")
+        if len(parts) != 2:
+            raise ValueError("Invalid folder format. Expected 'start_end' format, or start_folder and end_folder.")
+        (old_key, _), (new_key, _) = cached_scene(parts[0]), cached_scene(parts[1])
+        index = CHANGE_LAYERS[layer]
+
+        def render():
+            # The change is taken per tile from the cached scene rasters, no change raster is needed
+            with leased_scenes(old_key, new_key):
+                old = read_tile(result_cache.SCENE_CACHE_PATH / old_key / f"{index}.tif", bounds)
+                new = read_tile(result_cache.SCENE_CACHE_PATH / new_key / f"{index}.tif", bounds)
+            return render_png(new - old, *CHANGE_RANGE)
+        return f"{old_key}_{new_key}", render
+
+    raise ValueError(f"Unknown layer: {layer}")
+
+def get_tile(layer, folder, z, x, y, end_folder=None):
+    """Returns the PNG bytes of a tile from the in-memory LRU, rendering it on a miss."""
+    global _tiles_bytes
+    if not 0 <= z <= 24 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise ValueError(f"Invalid tile: {z}/{x}/{y}")
+    if not folder:
+        raise ValueError("No folder provided")
+
+    # Keyed by the scene cache keys, so tiles of changed bands are never served
+    source_key, render = tile_source(layer, folder, z, x, y, end_folder)
+    key = (layer, source_key, z, x, y)
+    with _lock:
+        if key in _tiles:
+            _tiles.move_to_end(key)
+            metrics.inc("ndvi_cache_requests_total", cache="tile", outcome="hit")
+            return _tiles[key]
+
+    metrics.inc("ndvi_cache_requests_total", cache="tile", outcome="miss")
+    png = render()
+    with _lock:
+        if key not in _tiles:
+            _tiles[key] = png
+            _tiles_bytes += len(png)
+        while _tiles_bytes > TILE_CACHE_MAX_BYTES and _tiles:
+            _, evicted = _tiles.popitem(last=False)
+            _tiles_bytes -= len(evicted)
+    return png
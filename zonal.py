@@ -0,0 +1,133 @@
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from rasterio import features, windows
+from rasterio.errors import CRSError
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+
+import ndvi_calc
+
+MASK_CACHE_MAX_BYTES = ndvi_calc.config["mask_cache_mb"] * 1024 * 1024
+# GeoJSON coordinates are WGS84 longitude/latitude unless the request names another CRS
+GEOJSON_CRS = "EPSG:4326"
+POLYGON_TYPES = ("Polygon", "MultiPolygon")
+
+_masks = OrderedDict()
+_masks_bytes = 0
+_lock = threading.Lock()
+
+def parse_features(geojson):
+    """Returns the features of a GeoJSON FeatureCollection, Feature, feature list or bare polygon geometry.
+
+    Raises ValueError when there are none or one is not a polygon.
+    """
+    if isinstance(geojson, dict) and geojson.get("type") == "FeatureCollection":
+        geojson = geojson.get("features")
+    if isinstance(geojson, dict):
+        geojson = [geojson if geojson.get("type") == "Feature" else {"type": "Feature", "geometry": geojson}]
+    if not isinstance(geojson, list) or not geojson:
+        raise ValueError("Expected GeoJSON polygons")
+
+    for i, feature in enumerate(geojson):
+        geometry = feature.get("geometry") if isinstance(feature, dict) else None
+        if not isinstance(geometry, dict) or geometry.get("type") not in POLYGON_TYPES or not geometry.get("coordinates"):
+            raise ValueError(f"Feature {i} is not a Polygon or MultiPolygon")
+    return geojson
+
+def polygon_window(geometry, transform, grid):
+    """Returns the window of the grid covering a geometry's bounds, or None if they don't intersect."""
+    window = windows.from_bounds(*features.bounds(geometry), transform=transform)
+    col_start, row_start = max(math.floor(window.col_off), 0), max(math.floor(window.row_off), 0)
+    col_end = min(math.ceil(window.col_off + window.width), grid.width)
+    row_end = min(math.ceil(window.row_off + window.height), grid.height)
+    if col_end <= col_start or row_end <= row_start:
+        return None
+    return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+def polygon_mask(geometry, crs, transform, window):
+    """Returns the boolean mask of the pixels of window whose centres fall in the geometry.
+
+    Masks are kept in an in-memory LRU keyed by the geometry and the grid, so repeated queries
+    of the same parcels skip rasterization.
+    """
+    global _masks_bytes
+    payload = json.dumps([geometry, str(crs), list(transform)[:6], [window.col_off, window.row_off, window.width, window.height]], sort_keys=True)
+    key = hashlib.sha256(payload.encode()).hexdigest()
+    with _lock:
+        if key in _masks:
+            _masks.move_to_end(key)
+            return _masks[key]
+
+    mask = features.geometry_mask([geometry], out_shape=(window.height, window.width), transform=windows.transform(window, transform), invert=True)
+    with _lock:
+        if key not in _masks and mask.nbytes <= MASK_CACHE_MAX_BYTES:
+            _masks[key] = mask
+            _masks_bytes += mask.nbytes
+        while _masks_bytes > MASK_CACHE_MAX_BYTES and _masks:
+            _, evicted = _masks.popitem(last=False)
+            _masks_bytes -= evicted.nbytes
+    return mask
+
+def row_chunks(window, tile_memory_mb=ndvi_calc.TILE_MEMORY_MB, bytes_per_pixel=ndvi_calc.CHANGE_BYTES_PER_PIXEL):
+    """Splits a window into full-width row bands that fit in tile_memory_mb."""
+    rows = max(int(tile_memory_mb * 1024 * 1024 // (window.width * bytes_per_pixel)), 1)
+    for row in range(0, window.height, rows):
+        yield row, Window(window.col_off, window.row_off + row, window.width, min(rows, window.height - row))
+
+def polygon_stats(change, geometry, alert_threshold):
+    """Returns the pixel counts, areas and deforestation percentage of one polygon."""
+    window = polygon_window(geometry, change["transform"], change["grid"])
+    pixels = valid_pixels = deforested_pixels = 0
+    if window is not None:
+        mask = polygon_mask(geometry, change["crs"], change["transform"], window)
+        # Only the polygon's bounding window is read, in bands bounded by tile_memory_mb
+        for row, chunk in row_chunks(window):
+            inside = mask[row:row + chunk.height]
+            if not inside.any():
+                continue
+            tiles = change["tiles"](chunk)
+            valid = inside.copy()
+            for name in change["changes"]:
+                valid &= ndvi_calc.valid_change(tiles[name], change["scale"])
+            pixels += int(np.count_nonzero(inside))
+            valid_pixels += int(np.count_nonzero(valid))
+            deforested_pixels += int(np.count_nonzero(tiles["deforested"] & inside))
+
+    area = ndvi_calc.pixel_area_m2(change["crs"], change["transform"])
+    stats = {
+        "pixels": pixels,
+        "valid_pixels": valid_pixels,
+        "deforested_pixels": deforested_pixels,
+        "area_m2": None if area is None else pixels * area,
+        "deforested_area_m2": None if area is None else deforested_pixels * area,
+    }
+    if pixels:
+        stats.update(ndvi_calc.deforestation_result(deforested_pixels, pixels, alert_threshold))
+    else:
+        stats.update(deforestation_percentage=None, status="Polygon does not overlap the scenes")
+    return stats
+
+def zonal_stats(start_folder, end_folder, geojson, params=None, crs=GEOJSON_CRS):
+    """Returns per-polygon deforestation statistics of a folder pair for GeoJSON polygons in crs.
+
+    Scenes are taken from the scene cache; FileNotFoundError is raised for a scene no analysis
+    has computed yet. Only the windows of the change grid that intersect each polygon are read.
+    """
+    params = params or ndvi_calc.ANALYSIS_PARAMS
+    polygons = parse_features(geojson)
+    results = []
+    with ndvi_calc.analysed_scene(start_folder, params["L"]) as old_scene, ndvi_calc.analysed_scene(end_folder, params["L"]) as new_scene, \
+         ndvi_calc.open_change(old_scene, new_scene, ndvi_calc.change_thresholds(params)) as change:
+        for i, feature in enumerate(polygons):
+            try:
+                geometry = transform_geom(crs, change["crs"], feature["geometry"])
+            except (CRSError, ValueError, TypeError) as e:
+                raise ValueError(f"Feature {i}: {e}")
+            stats = polygon_stats(change, geometry, params["deforestation_alert_threshold"])
+            results.append(dict(id=feature.get("id", i), properties=feature.get("properties") or {}, **stats))
+    return results